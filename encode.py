@@ -2,28 +2,68 @@
 # Usage:
 #  PYTHONPATH=src ./encode.py <file|directory|glob> /path/to/output.npz
 #  PYTHONPATH=src ./train --dataset /path/to/output.npz
+#
+#  Sharded output, encoded by 8 processes:
+#  PYTHONPATH=src ./encode.py --jobs 8 <file|directory|glob> /path/to/output_dir
+#  PYTHONPATH=src ./train --dataset /path/to/output_dir/manifest.json
 
 import argparse
+import json
+import multiprocessing
 import numpy as np
+import os
 
 import encoder
-from load_dataset import load_dataset
+import load_dataset
+from load_dataset import load_dataset as read_dataset
 
 parser = argparse.ArgumentParser(
     description='Pre-encode text files into tokenized training set.',
     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parser.add_argument('--model_name', metavar='MODEL', type=str, default='117M', help='Pretrained model name')
 parser.add_argument('--combine', metavar='CHARS', type=int, default=50000, help='Concatenate files with <|endoftext|> separator into chunks of this minimum size')
+parser.add_argument('--jobs', metavar='N', type=int, default=1, help='Number of encoder processes')
 parser.add_argument('in_text', metavar='PATH', type=str, help='Input file, directory, or glob pattern (utf-8 text).')
-parser.add_argument('out_npz', metavar='OUT.npz', type=str, help='Output file path')
+parser.add_argument('out_npz', metavar='OUT.npz', type=str, help='Output file path. If it does not end in .npz, write one shard per chunk into this directory along with a manifest.json')
+
+def write_shard(out_dir, index, tokens):
+    name = 'shard-%06d.npz' % index
+    np.savez_compressed(os.path.join(out_dir, name), tokens)
+    return name, len(tokens)
+
+def encode_shard(out_dir, index, text):
+    return write_shard(out_dir, index, load_dataset.encode_chunk(text))
+
+def encode_shards(enc, chunks, out_dir, jobs):
+    os.makedirs(out_dir, exist_ok=True)
+    with multiprocessing.Pool(jobs, initializer=encoder.init_worker, initargs=(enc,)) as pool:
+        def submit():
+            for index, chunk in enumerate(chunks):
+                if isinstance(chunk, np.ndarray):
+                    yield write_shard(out_dir, index, chunk)
+                else:
+                    yield pool.apply_async(encode_shard, (out_dir, index, chunk))
+        return list(encoder.ordered_results(submit(), 2 * jobs))
 
 def main():
     args = parser.parse_args()
     enc = encoder.get_encoder(args.model_name)
     print('Reading files')
-    chunks = load_dataset(enc, args.in_text, args.combine)
-    print('Writing', args.out_npz)
-    np.savez_compressed(args.out_npz, *chunks)
+    if args.out_npz.endswith('.npz'):
+        chunks = read_dataset(enc, args.in_text, args.combine, jobs=args.jobs)
+        print('Writing', args.out_npz)
+        np.savez_compressed(args.out_npz, *chunks)
+    else:
+        chunks = load_dataset.iter_chunks(load_dataset.dataset_paths(args.in_text), args.combine)
+        shards = encode_shards(enc, chunks, args.out_npz, max(1, args.jobs))
+        manifest = os.path.join(args.out_npz, load_dataset.MANIFEST)
+        print('Writing', manifest)
+        with open(manifest, 'w') as f:
+            json.dump({
+                'combine': args.combine,
+                'tokens': sum(tokens for _, tokens in shards),
+                'shards': [{'path': name, 'tokens': tokens} for name, tokens in shards],
+                }, f, indent=2)
 
 
 if __name__ == '__main__':
@@ -4,7 +4,9 @@
 #  PYTHONPATH=src ./train --dataset /path/to/output.npz
 
 import argparse
+import json
 import numpy as np
+import os
 import sys
 import tqdm
 
@@ -17,15 +19,79 @@ parser = argparse.ArgumentParser(
     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parser.add_argument('infile', metavar='PATH', type=str, help='Input file, directory, or glob pattern (utf-8 text).')
 parser.add_argument('--outfile', default="-", type=str, help='Output file path, or - for stdout')
+parser.add_argument('--start', default=0, type=int, help='Byte offset of the input line to start at. Appends to --outfile if > 0')
+parser.add_argument('--jobs', default=1, type=int, help='Number of processes running ftfy')
+parser.add_argument('--batch_lines', default=1000, type=int, help='Number of lines handed to a process at a time')
+parser.add_argument('--resume', default=False, action='store_true', help='Continue from the position recorded in OUTFILE.progress')
+
+def fix_lines(lines):
+    return ''.join(fix_text(line) for line in lines)
+
+def batches(infile, start, n):
+    lines = []
+    for i, line, offset in tflex_utils.for_each_line(infile, message='Fixing', start=start, offsets=True):
+      lines.append(line)
+      if len(lines) >= n:
+        yield lines, offset
+        lines = []
+    if lines:
+      yield lines, offset
+
+def fixed_batches(args, start):
+    """Yields (text, end_offset) for each input batch, in input order."""
+    if args.jobs <= 1:
+      for lines, offset in batches(args.infile, start, args.batch_lines):
+        yield fix_lines(lines), offset
+      return
+    import collections
+    import multiprocessing
+    with multiprocessing.Pool(args.jobs) as pool:
+      # reordering buffer; bounded so we never read far ahead of the writer
+      pending = collections.deque()
+      for lines, offset in batches(args.infile, start, args.batch_lines):
+        pending.append((pool.apply_async(fix_lines, (lines,)), offset))
+        while len(pending) > 2 * args.jobs:
+          result, end = pending.popleft()
+          yield result.get(), end
+      while pending:
+        result, end = pending.popleft()
+        yield result.get(), end
+
+def read_progress(path):
+    try:
+      with open(path) as f:
+        progress = json.load(f)
+      return progress['in'], progress['out']
+    except FileNotFoundError:
+      return 0, 0
+
+def write_progress(path, offset, size):
+    with open(path + '.tmp', 'w') as f:
+      json.dump({'in': offset, 'out': size}, f)
+    os.replace(path + '.tmp', path)
 
 def main():
     args = parser.parse_args()
-    out = sys.stdout if args.outfile == '-' else open(args.outfile, "w")
-    for i, line in tflex_utils.for_each_line(args.infile, message='Fixing'):
-      fixed = fix_text(line)
-      out.write(fixed)
-      if i % 100 == 0:
-        out.flush()
+    start = args.start
+    progress = None
+    if args.outfile == '-':
+      out = sys.stdout.buffer
+    else:
+      progress = args.outfile + '.progress'
+      mode = "ab" if start > 0 else "wb"
+      if args.resume:
+        start, size = read_progress(progress)
+        mode = "r+b" if os.path.exists(args.outfile) else "wb"
+      out = open(args.outfile, mode)
+      if args.resume:
+        # drop anything written after the last recorded batch
+        out.truncate(size)
+        out.seek(size)
+    for text, offset in fixed_batches(args, start):
+      out.write(text.encode('utf-8'))
+      out.flush()
+      if progress is not None:
+        write_progress(progress, offset, out.tell())
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+sys.path += [os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')]
+sys.path += [os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))]
+
+import fire
+import time
+import numpy as np
+
+import model_numpy
+
+def benchmark(
+    model_name='117M',
+    restore_from=None,
+    batch_size=1,
+    context_length=16,
+    length=64,
+    top_k=40,
+    top_p=0.0,
+    seed=0,
+    runs=3,
+    tensorflow=True,
+):
+    """
+    Compare CPU tokens/sec of the NumPy engine against sample.sample_sequence
+    :model_name=117M : String, which model to use
+    :restore_from=None : Checkpoint or directory; defaults to models/<model_name>
+    :batch_size=1 : Number of sequences sampled at once
+    :context_length=16 : Number of random context tokens
+    :length=64 : Number of tokens to sample after the context
+    :runs=3 : Timed runs per engine, after one warmup run
+    :tensorflow=True : Also time TF and report the max logits difference
+    """
+    hparams = model_numpy.load_hparams(model_name)
+    if restore_from is None:
+        restore_from = os.path.join('models', model_name)
+    if os.path.isdir(restore_from):
+        import tflex
+        restore_from = tflex.latest_checkpoint(restore_from)
+    rng = np.random.RandomState(seed)
+    context = rng.randint(0, hparams['n_vocab'], size=[batch_size, context_length]).astype(np.int32)
+
+    start = time.time()
+    params = model_numpy.load_params(restore_from)
+    print('NumPy: loaded %s in %.2fs' % (restore_from, time.time() - start))
+    model_numpy.sample_sequence(params, hparams, length=length, context=context, top_k=top_k, top_p=top_p, rng=rng)
+    start = time.time()
+    tokens = 0
+    for _ in range(runs):
+        out = model_numpy.sample_sequence(params, hparams, length=length, context=context, top_k=top_k, top_p=top_p, rng=rng)
+        tokens += out[:, context_length:].size
+    elapsed = time.time() - start
+    print('NumPy: %.2f tokens/sec' % (tokens / elapsed))
+    logits_np = model_numpy.model(params, hparams, context)
+
+    if not tensorflow:
+        return
+    import tensorflow as tf
+    import tflex
+    import model, sample
+    tf_hparams = model.default_hparams()
+    tf_hparams.override_from_dict(hparams)
+    # keep TF on the CPU too, so both engines are compared on the same device
+    with tflex.Session(graph=tf.Graph(), config=tf.ConfigProto(device_count={'GPU': 0})) as sess:
+        context_in = tf.placeholder(tf.int32, [batch_size, None])
+        tf.set_random_seed(seed)
+        output = sample.sample_sequence(
+            hparams=tf_hparams, length=length,
+            context=context_in,
+            batch_size=batch_size,
+            top_k=top_k, top_p=top_p)
+        logits = model.model(hparams=tf_hparams, X=context_in)['logits']
+        saver = tflex.Saver()
+        saver.restore(sess, restore_from)
+        sess.run(output, feed_dict={context_in: context})
+        start = time.time()
+        tokens = 0
+        for _ in range(runs):
+            out = sess.run(output, feed_dict={context_in: context})
+            tokens += out[:, context_length:].size
+        elapsed = time.time() - start
+        print('TF: %.2f tokens/sec' % (tokens / elapsed))
+        logits_tf = sess.run(logits, feed_dict={context_in: context})[:, :, :hparams['n_vocab']]
+    print('Max logits difference: %g' % np.max(np.abs(logits_np - logits_tf)))
+
+if __name__ == '__main__':
+    fire.Fire(benchmark)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+sys.path += [os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')]
+sys.path += [os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))]
+
+import fire
+import json
+import time
+import tensorflow as tf
+import tflex
+
+import model
+
+def benchmark(
+    model_name='117M',
+    pad_vocab='0,64,128',
+    batch_size=4,
+    sequence=256,
+    steps=10,
+    train=True,
+    dtype='float32',
+):
+    """
+    Compare training or forward throughput with and without a padded vocabulary
+    :model_name=117M : String, which model's hparams to use; weights are random
+    :pad_vocab=0,64,128 : Comma separated multiples to compare; 0 is unpadded
+    :sequence=256 : Tokens per sequence
+    :steps=10 : Timed steps per setting, after one warmup step
+    :train=True : Time loss and gradients; otherwise only the forward pass
+    """
+    if isinstance(pad_vocab, str):
+        pad_vocab = [int(x) for x in pad_vocab.split(',')]
+    elif isinstance(pad_vocab, int):
+        pad_vocab = [pad_vocab]
+    for multiple in pad_vocab:
+        hparams = model.default_hparams()
+        with open(os.path.join('models', model_name, 'hparams.json')) as f:
+            hparams.override_from_dict(json.load(f))
+        hparams.dtype = tf.as_dtype(dtype)
+        hparams.pad_vocab = multiple
+        with tflex.Session(graph=tf.Graph()) as sess:
+            context = tf.random.uniform([batch_size, sequence], maxval=hparams.n_vocab, dtype=tf.int32)
+            logits = model.model(hparams=hparams, X=context)['logits']
+            loss = tf.reduce_mean(
+                tf.nn.sparse_softmax_cross_entropy_with_logits(
+                    labels=context[:, 1:], logits=tf.cast(logits[:, :-1], tf.float32)))
+            if train:
+                op = tf.gradients(loss, tf.trainable_variables())
+            else:
+                op = loss
+            sess.run(tf.global_variables_initializer())
+            sess.run(op)
+            start = time.time()
+            for _ in range(steps):
+                sess.run(op)
+            elapsed = time.time() - start
+        print('pad_vocab=%-4d wte rows %6d  %8.1f tokens/sec' % (
+            multiple, model.padded_vocab(hparams), steps * batch_size * sequence / elapsed))
+
+if __name__ == '__main__':
+    fire.Fire(benchmark)
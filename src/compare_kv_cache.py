@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+sys.path += [os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')]
+sys.path += [os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))]
+
+import fire
+import json
+import numpy as np
+import tensorflow as tf
+import tflex
+
+import model, encoder
+
+def compare_kv_cache(
+    model_name='117M',
+    restore_from=None,
+    prompt=None,
+    batch_size=4,
+    length=128,
+    split=None,
+    cache_dtypes='float16,bfloat16,int8',
+    seed=0,
+):
+    """
+    Measure how far logits move when the KV cache is stored in lower precision
+    :model_name=117M : String, which model to use
+    :restore_from=None : Checkpoint or directory; defaults to models/<model_name>
+    :prompt=None : Text or file to encode; if None, random tokens are used
+    :length=128 : Number of tokens per sequence
+    :split=None : Tokens before this position go through the cache; defaults
+     to length // 2
+    :cache_dtypes=float16,bfloat16,int8 : Comma separated storage dtypes to compare
+    """
+    hparams = model.default_hparams()
+    with open(os.path.join('models', model_name, 'hparams.json')) as f:
+        hparams.override_from_dict(json.load(f))
+    if restore_from is None:
+        restore_from = os.path.join('models', model_name)
+    if split is None:
+        split = length // 2
+    if isinstance(cache_dtypes, str):
+        cache_dtypes = cache_dtypes.split(',')
+
+    rng = np.random.RandomState(seed)
+    if prompt is None:
+        tokens = rng.randint(0, hparams.n_vocab, size=[batch_size, length])
+    else:
+        enc = encoder.get_encoder(model_name)
+        if os.path.isfile(prompt):
+            with open(prompt) as f:
+                prompt = f.read()
+        tokens = np.array([enc.encode(prompt)[:length]] * batch_size)
+        length = tokens.shape[1]
+
+    with tflex.Session(graph=tf.Graph()) as sess:
+        X = tf.placeholder(tf.int32, [batch_size, None])
+        reference = model.model(hparams=hparams, X=X)['logits'][:, split:]
+        present = model.model(hparams=hparams, X=X[:, :split])['present']
+        results = {}
+        for cache_dtype in cache_dtypes:
+            past = model.compress_past(present, cache_dtype)
+            results[cache_dtype] = model.model(hparams=hparams, X=X[:, split:], past=past)['logits']
+        saver = tflex.Saver()
+        saver.restore(sess, tflex.latest_checkpoint(restore_from) if os.path.isdir(restore_from) else restore_from)
+        reference, results = sess.run((reference, results), feed_dict={X: tokens})
+
+    reference = reference.astype(np.float32)
+    features = hparams.n_embd // hparams.n_head
+    for cache_dtype in cache_dtypes:
+        logits = results[cache_dtype].astype(np.float32)
+        diff = np.abs(logits - reference)
+        agree = np.mean(np.argmax(logits, axis=-1) == np.argmax(reference, axis=-1))
+        itemsize = tf.as_dtype(cache_dtype).size
+        per_token = 2 * hparams.n_layer * hparams.n_head * (features * itemsize + (4 if cache_dtype == 'int8' else 0))
+        print('%-9s cache %6.1f KB/token  max diff %.5f  mean diff %.5f  argmax agreement %.4f' % (
+            cache_dtype, per_token / 1024, np.max(diff), np.mean(diff), agree))
+
+if __name__ == '__main__':
+    fire.Fire(compare_kv_cache)
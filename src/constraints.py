@@ -0,0 +1,92 @@
+"""Token-level constraints for sample.sample_sequence, compiled ahead of
+time into sparse transition tables that the sampling loop indexes
+in-graph, so a constrained step costs the same as an unconstrained one."""
+
+import json
+import numpy as np
+
+class Constraint(object):
+    """A DFA over token ids. State 0 is the start state; each sampled token
+    must have a transition out of the current state."""
+
+    def __init__(self, n_vocab):
+        self.n_vocab = n_vocab
+        self.transitions = [{}]
+
+    @property
+    def n_states(self):
+        return len(self.transitions)
+
+    def add_state(self):
+        self.transitions.append({})
+        return len(self.transitions) - 1
+
+    def add_transition(self, state, token, next_state):
+        assert 0 <= token < self.n_vocab, 'Token %d is outside the vocabulary' % token
+        existing = self.transitions[state].get(token, next_state)
+        assert existing == next_state, 'State %d already moves on token %d to state %d' % (state, token, existing)
+        self.transitions[state][token] = next_state
+
+    def compile(self):
+        """Returns sparse tables (offsets, keys, next_states): keys are the
+        sorted state * n_vocab + token of every transition, next_states the
+        matching target states, and the transitions of state s are
+        keys[offsets[s]:offsets[s + 1]]."""
+        keys = []
+        next_states = []
+        for state, edges in enumerate(self.transitions):
+            assert edges, 'State %d has no way out' % state
+            for token, next_state in sorted(edges.items()):
+                keys.append(state * self.n_vocab + token)
+                next_states.append(next_state)
+        keys = np.array(keys, dtype=np.int64)
+        offsets = np.searchsorted(keys, np.arange(self.n_states + 1, dtype=np.int64) * self.n_vocab).astype(np.int32)
+        return offsets, keys, np.array(next_states, dtype=np.int32)
+
+    def mask(self):
+        """Dense [n_states, n_vocab] bool table of allowed tokens, for
+        inspecting small constraints."""
+        _, keys, _ = self.compile()
+        mask = np.zeros([self.n_states, self.n_vocab], dtype=np.bool_)
+        mask[keys // self.n_vocab, keys % self.n_vocab] = True
+        return mask
+
+class TokenTrie(Constraint):
+    """Restricts generation to one of a fixed set of token sequences. Once a
+    sequence is complete, only end_token can follow. With repeat, the
+    end_token returns to the start state so another sequence may follow."""
+
+    def __init__(self, n_vocab, end_token, repeat=False):
+        super().__init__(n_vocab)
+        self.end_token = end_token
+        self.repeat = repeat
+        self.done = self.add_state()
+        self.add_transition(self.done, end_token, self.done)
+
+    def add(self, tokens):
+        assert len(tokens) > 0, 'Cannot add an empty sequence'
+        state = 0
+        for token in tokens:
+            next_state = self.transitions[state].get(token)
+            if next_state is None:
+                next_state = self.add_state()
+                self.add_transition(state, token, next_state)
+            state = next_state
+        self.add_transition(state, self.end_token, 0 if self.repeat else self.done)
+
+def phrase_trie(enc, phrases, repeat=False):
+    trie = TokenTrie(enc.vocab_size, enc.token_to_id('<|endoftext|>'), repeat=repeat)
+    for phrase in phrases:
+        trie.add(enc.encode(phrase))
+    return trie
+
+def load_constraint(enc, path, repeat=False):
+    """Reads phrases from a .json list or from a text file with one phrase
+    per line, and builds the matching TokenTrie."""
+    if path.endswith('.json'):
+        with open(path) as f:
+            phrases = json.load(f)
+    else:
+        with open(path, encoding='utf-8') as f:
+            phrases = [line.rstrip('\n') for line in f if line.strip()]
+    return phrase_trie(enc, phrases, repeat=repeat)
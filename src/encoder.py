@@ -1,8 +1,18 @@
 """Byte pair encoding utilities"""
 
+import codecs
+import collections
+import hashlib
+import heapq
+import importlib.util
+import multiprocessing
+import multiprocessing.pool
 import os
 import json
+import numpy as np
+import pickle
 import regex as re
+import sys
 from functools import lru_cache
 
 @lru_cache()
@@ -39,28 +49,121 @@ def get_pairs(word):
         prev_char = char
     return pairs
 
+def byte_table(decoder, byte_decoder):
+    """Returns (data, offsets, lengths): the raw bytes of every token id
+    concatenated into one uint8 array, and where each token's bytes start."""
+    n = max(decoder) + 1
+    pieces = [bytes(byte_decoder[c] for c in decoder[i]) if i in decoder else b'' for i in range(n)]
+    lengths = np.array([len(piece) for piece in pieces], dtype=np.int64)
+    offsets = np.zeros(n, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)[:-1]
+    data = np.frombuffer(b''.join(pieces), dtype=np.uint8)
+    return data, offsets, lengths
+
+def gather_bytes(table, tokens, block=1<<22):
+    """Gathers the utf-8 bytes of a token sequence from a byte table."""
+    data, offsets, lengths = table
+    ids = np.asarray(tokens, dtype=np.int64).reshape([-1])
+    if ids.size > 0 and (ids.min() < 0 or ids.max() >= len(lengths)):
+        raise KeyError('Token id out of range')
+    parts = []
+    for i in range(0, ids.size, block):
+        # expand every token into the positions of its bytes in `data`
+        chunk = ids[i:i + block]
+        lens = lengths[chunk]
+        ends = np.cumsum(lens)
+        if ends.size == 0 or ends[-1] == 0:
+            continue
+        idx = np.arange(ends[-1]) + np.repeat(offsets[chunk] - (ends - lens), lens)
+        parts.append(data[idx].tobytes())
+    return b''.join(parts)
+
+class IncrementalDecoder(object):
+    """Decodes a stream of tokens, emitting text as soon as it is complete.
+
+    Tokens may split a multi-byte character; the incomplete tail is held
+    back until the tokens that finish it arrive."""
+
+    def __init__(self, enc, errors='replace'):
+        self.enc = enc
+        self.errors = errors
+        self.reset()
+
+    def reset(self):
+        self.decoder = codecs.getincrementaldecoder('utf-8')(self.errors)
+
+    def decode(self, tokens):
+        if isinstance(tokens, int):
+            tokens = [tokens]
+        return self.decoder.decode(self.enc.decode_bytes(tokens))
+
+    def flush(self):
+        return self.decoder.decode(b'', final=True)
+
+class LRUCache(object):
+    """Bounded mapping that evicts the least recently used entry."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.data.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.data.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __len__(self):
+        return len(self.data)
+
 class Encoder:
-    def __init__(self, encoder, bpe_merges, errors='replace'):
+    def __init__(self, encoder, bpe_merges=None, errors='replace', cache_size=2**16, heap_threshold=32, bpe_ranks=None, decoder=None):
         self.encoder = encoder
-        self.decoder = {v:k for k,v in self.encoder.items()}
+        self.decoder = decoder if decoder is not None else {v:k for k,v in self.encoder.items()}
         self.errors = errors # how to handle errors in decoding
         self.byte_encoder = bytes_to_unicode()
         self.byte_decoder = {v:k for k, v in self.byte_encoder.items()}
-        self.bpe_ranks = dict(zip(bpe_merges, range(len(bpe_merges))))
-        self.cache = {}
+        self.bpe_ranks = bpe_ranks if bpe_ranks is not None else dict(zip(bpe_merges, range(len(bpe_merges))))
+        self.fingerprint = None
+        self._byte_table = None
+        self.cache = LRUCache(cache_size)
+        self.heap_threshold = heap_threshold
 
         # Should haved added re.IGNORECASE so BPE merges can happen for capitalized versions of contractions
         self.pat = re.compile(r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+""")
 
     def bpe(self, token):
-        if token in self.cache:
-            return self.cache[token]
+        word = self.cache.get(token)
+        if word is not None:
+            return word
+        if len(token) < 2:
+            return token
+        if len(token) > self.heap_threshold:
+            word = self.bpe_heap(token)
+        else:
+            word = self.bpe_scan(token)
+        self.cache.put(token, word)
+        return word
+
+    def bpe_scan(self, token):
         word = tuple(token)
         pairs = get_pairs(word)
 
-        if not pairs:
-            return token
-
         while True:
             bigram = min(pairs, key = lambda pair: self.bpe_ranks.get(pair, float('inf')))
             if bigram not in self.bpe_ranks:
@@ -89,11 +192,58 @@ class Encoder:
                 break
             else:
                 pairs = get_pairs(word)
-        word = ' '.join(word)
-        self.cache[token] = word
-        while len(self.cache) > 1000:
-          self.cache.popitem()
-        return word
+        return ' '.join(word)
+
+    def bpe_heap(self, token):
+        """Same merges as bpe_scan, in O(n log n) for long tokens.
+
+        Symbols live in a linked list indexed by their original position.
+        Candidate pairs sit in a heap keyed by (rank, position); all pairs
+        of the lowest rank are merged left to right in one round, exactly
+        like one iteration of the scanning loop."""
+        ranks = self.bpe_ranks
+        syms = list(token)
+        nxt = list(range(1, len(syms))) + [-1]
+        prv = list(range(-1, len(syms) - 1))
+        heap = []
+        for i in range(len(syms) - 1):
+            rank = ranks.get((syms[i], syms[i+1]))
+            if rank is not None:
+                heap.append((rank, i, syms[i], syms[i+1]))
+        heapq.heapify(heap)
+
+        def push(i):
+            j = nxt[i]
+            if i >= 0 and j >= 0:
+                rank = ranks.get((syms[i], syms[j]))
+                if rank is not None:
+                    heapq.heappush(heap, (rank, i, syms[i], syms[j]))
+
+        while heap:
+            rank = heap[0][0]
+            batch = []
+            while heap and heap[0][0] == rank:
+                batch.append(heapq.heappop(heap))
+            batch.sort()
+            for _, i, first, second in batch:
+                j = nxt[i]
+                # skip stale entries whose symbols were merged away
+                if syms[i] != first or j < 0 or syms[j] != second:
+                    continue
+                syms[i] = first + second
+                syms[j] = None
+                nxt[i] = nxt[j]
+                if nxt[j] >= 0:
+                    prv[nxt[j]] = i
+                push(prv[i])
+                push(i)
+
+        word = []
+        i = 0
+        while i >= 0:
+            word.append(syms[i])
+            i = nxt[i]
+        return ' '.join(word)
 
     def encode(self, text):
         bpe_tokens = []
@@ -103,19 +253,71 @@ class Encoder:
         return bpe_tokens
 
     def decode(self, tokens):
-        text = ''.join([self.decoder[token] for token in tokens])
-        text = bytearray([self.byte_decoder[c] for c in text]).decode('utf-8', errors=self.errors)
-        return text
+        return self.decode_bytes(tokens).decode('utf-8', errors=self.errors)
+
+    def decode_bytes(self, tokens, block=1<<22):
+        return gather_bytes(self.byte_table(), tokens, block=block)
+
+    def byte_table(self):
+        if self._byte_table is None:
+            self._byte_table = byte_table(self.decoder, self.byte_decoder)
+        return self._byte_table
+
+    def encode_batch(self, texts, jobs=None, min_parallel_chars=1<<20):
+        """Encodes a list of texts, fanning out over a process pool when
+        there is enough text to pay for starting one."""
+        texts = list(texts)
+        if jobs is None:
+            jobs = os.cpu_count() or 1
+        jobs = min(jobs, len(texts))
+        if jobs <= 1 or sum(len(text) for text in texts) < min_parallel_chars:
+            return [self.encode(text) for text in texts]
+        with multiprocessing.Pool(jobs, initializer=init_worker, initargs=(self,)) as pool:
+            return pool.map(worker_encode, texts, chunksize=max(1, len(texts) // (4 * jobs)))
+
+    def decode_batch(self, tokens):
+        return [self.decode(ids) for ids in tokens]
+
+    def token_to_id(self, token):
+        """Returns the id of a vocabulary entry, or None."""
+        return self.encoder.get(token)
 
-try:
-  from tokenizers import Tokenizer, models, pre_tokenizers, decoders
-  use_high_speed_tokenizer = True
-  print('Using high-speed tokenizer')
-except:
-  use_high_speed_tokenizer = False
+    @property
+    def vocab_size(self):
+        return len(self.encoder)
+
+_worker_enc = None
+
+def init_worker(enc):
+    """Pool initializer: sends `enc` to each worker once, for worker_encode."""
+    global _worker_enc
+    _worker_enc = enc
+
+def worker_encode(text):
+    return _worker_enc.encode(text)
+
+def ordered_results(results, window):
+    """Yields `results` in order, resolving pool AsyncResults as they come
+    due. `results` should be a generator that submits work lazily, so that
+    at most `window` items are in flight ahead of the consumer."""
+    pending = collections.deque()
+    for result in results:
+        pending.append(result)
+        while len(pending) > window:
+            yield resolve_result(pending.popleft())
+    while pending:
+        yield resolve_result(pending.popleft())
+
+def resolve_result(result):
+    return result.get() if isinstance(result, multiprocessing.pool.AsyncResult) else result
+
+# The native tokenizer is imported by HighSpeedTokenizer itself, so that
+# importing this module stays cheap for tools that never encode anything.
+use_high_speed_tokenizer = importlib.util.find_spec('tokenizers') is not None
 
 class HighSpeedTokenizer(object):
   def __init__(self, vocab_path, bpe_merges_path):
+    from tokenizers import Tokenizer, models, pre_tokenizers, decoders
     tokenizer = Tokenizer(models.BPE.from_files(vocab_path, bpe_merges_path))
     # Use the byte level
     add_prefix_spaces = False # Whether to automatically prefix the sequences with a space if none found
@@ -146,36 +348,132 @@ class HighSpeedTokenizer(object):
         pad_token
       )
     self.tokenizer = tokenizer
+    self.vocab_path = vocab_path
+    self._byte_table = None
+    self._vocab = None
 
-  def encode(self, text):
-    tokens = []
+  def pieces(self, text):
+    pieces = []
     lines = text.splitlines()
     c = '\n'
     n = len(lines) - 1
     for i, line in enumerate(lines):
       if i >= n:
         c = ''
-      encoding = self.tokenizer.encode(line + c)
-      tokens.extend(encoding.ids)
+      pieces.append(line + c)
     if text.endswith('\n'):
-      tokens.extend(self.tokenizer.encode('\n').ids)
+      pieces.append('\n')
+    return pieces
+
+  def encode(self, text):
+    tokens = []
+    for piece in self.pieces(text):
+      encoding = self.tokenizer.encode(piece)
+      tokens.extend(encoding.ids)
     return tokens
 
   def decode(self, tokens):
     text = self.tokenizer.decode(tokens, False)
     return text
 
-def get_encoder(model_name):
-    vocab_path = os.path.join('models', model_name, 'encoder.json')
-    bpe_merges_path = os.path.join('models', model_name, 'vocab.bpe')
-    if use_high_speed_tokenizer:
-      return HighSpeedTokenizer(vocab_path=vocab_path, bpe_merges_path=bpe_merges_path)
+  def decode_bytes(self, tokens):
+    if self._byte_table is None:
+      decoder = {v:k for k,v in self.vocab().items()}
+      byte_decoder = {v:k for k, v in bytes_to_unicode().items()}
+      self._byte_table = byte_table(decoder, byte_decoder)
+    return gather_bytes(self._byte_table, tokens)
+
+  def encode_batch(self, texts, jobs=None):
+    # one native call over every line of every text, then regroup
+    texts = list(texts)
+    pieces = [self.pieces(text) for text in texts]
+    encodings = self.tokenizer.encode_batch([piece for ps in pieces for piece in ps])
+    results = []
+    i = 0
+    for ps in pieces:
+      tokens = []
+      for encoding in encodings[i:i + len(ps)]:
+        tokens.extend(encoding.ids)
+      results.append(tokens)
+      i += len(ps)
+    return results
+
+  def decode_batch(self, tokens):
+    tokens = [[int(x) for x in ids] for ids in tokens]
+    if hasattr(self.tokenizer, 'decode_batch'):
+      return self.tokenizer.decode_batch(tokens, False)
+    return [self.decode(ids) for ids in tokens]
+
+  def vocab(self):
+    # encoder.json, read on first use
+    if self._vocab is None:
+      with open(self.vocab_path, 'r') as f:
+        self._vocab = json.load(f)
+    return self._vocab
+
+  def token_to_id(self, token):
+    """Returns the id of a vocabulary entry, or None."""
+    return self.vocab().get(token)
+
+  @property
+  def vocab_size(self):
+    return len(self.vocab())
+
+def fingerprint_files(*paths):
+    h = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def read_tables(vocab_path, bpe_merges_path):
     with open(vocab_path, 'r') as f:
         encoder = json.load(f)
     with open(bpe_merges_path, 'r', encoding="utf-8") as f:
         bpe_data = f.read()
     bpe_merges = [tuple(merge_str.split()) for merge_str in bpe_data.split('\n')[1:-1]]
-    return Encoder(
-        encoder=encoder,
-        bpe_merges=bpe_merges,
+    return {
+        'encoder': encoder,
+        'decoder': {v:k for k,v in encoder.items()},
+        'bpe_ranks': dict(zip(bpe_merges, range(len(bpe_merges)))),
+    }
+
+def load_tables(vocab_path, bpe_merges_path, fingerprint):
+    """Loads the parsed vocab, caching it as a pickle next to the source files.
+
+    The cache name includes a hash of encoder.json and vocab.bpe, so edited
+    vocab files get a fresh cache and every process shares the same one."""
+    cache_path = os.path.join(os.path.dirname(vocab_path), 'encoder-%s.pickle' % fingerprint[:16])
+    try:
+        with open(cache_path, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass
+    tables = read_tables(vocab_path, bpe_merges_path)
+    tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(tables, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # read-only model directory; just go without the cache
+        pass
+    return tables
+
+def get_encoder(model_name):
+    vocab_path = os.path.join('models', model_name, 'encoder.json')
+    bpe_merges_path = os.path.join('models', model_name, 'vocab.bpe')
+    fingerprint = fingerprint_files(vocab_path, bpe_merges_path)
+    if use_high_speed_tokenizer:
+      sys.stderr.write('Using high-speed tokenizer\n')
+      enc = HighSpeedTokenizer(vocab_path=vocab_path, bpe_merges_path=bpe_merges_path)
+      enc.fingerprint = fingerprint
+      return enc
+    tables = load_tables(vocab_path, bpe_merges_path, fingerprint)
+    enc = Encoder(
+        encoder=tables['encoder'],
+        bpe_ranks=tables['bpe_ranks'],
+        decoder=tables['decoder'],
     )
+    enc.fingerprint = fingerprint
+    return enc
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+sys.path += [os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')]
+sys.path += [os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))]
+
+import fire
+import json
+import tensorflow as tf
+import tflex
+import tflex_utils
+
+import model
+
+def export_weights(
+    model_name='117M',
+    restore_from=None,
+    out=None,
+):
+    """
+    Export a checkpoint to a memory-mappable weights file
+    :model_name=117M : String, which model to use
+    :restore_from=None : Checkpoint or directory to export; defaults to
+     models/<model_name>
+    :out=None : Output path; defaults to models/<model_name>/model.weights.
+     The tensor index is written to the same path plus .json. Samplers load
+     it when it is given as --restore_from, or found in that directory.
+    """
+    hparams = model.default_hparams()
+    with open(os.path.join('models', model_name, 'hparams.json')) as f:
+        hparams.override_from_dict(json.load(f))
+    if restore_from is None:
+        restore_from = os.path.join('models', model_name)
+    if out is None:
+        out = os.path.join('models', model_name, 'model.weights')
+
+    with tflex.Session(graph=tf.Graph()) as sess:
+        context = tf.placeholder(tf.int32, [1, None])
+        model.model(hparams=hparams, X=context)
+        var_list = [v for v in tf.trainable_variables() if 'model' in v.name]
+        saver = tflex.Saver(var_list=var_list)
+        ckpt = restore_from if os.path.isfile(restore_from) else tflex.latest_checkpoint(restore_from)
+        print('Loading snapshot %s...' % ckpt)
+        saver.restore(sess, ckpt)
+        print('Writing %s...' % out)
+        tflex_utils.export_weights(out, tflex.snapshot_variables(session=sess, var_list=var_list))
+
+if __name__ == '__main__':
+    fire.Fire(export_weights)
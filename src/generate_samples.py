@@ -28,9 +28,6 @@ def clear_output(wait=False):
   else:
       print("\033c", end="")
 
-def is_ascii(s):
-    return all(ord(c) < 128 for c in s)
-
 def interact_model(
     model_name='117M',
     restore_from=None,
@@ -123,8 +120,7 @@ def interact_model(
             tflex.context_tokens = tflex.context_tokens[1:]
           tflex.prompt_tokens = tflex.context_tokens[:]
           tflex.first = True
-          tflex.backlog = []
-          tflex.backlog_count = 0
+          tflex.detokenizer = encoder.IncrementalDecoder(enc)
           tflex.context_text = ""
           tflex.context_count = 0
           while True:
@@ -135,28 +131,25 @@ def interact_model(
                 sys.stdout.write(enc.decode(tflex.context_tokens))
                 sys.stdout.flush()
                 tflex.first = False
-              tflex.backlog.extend(tflex.tokens)
-              tflex.backlog_count += 1
-              if is_ascii(enc.decode([tflex.backlog[-1]])) or tflex.backlog_count > 16:
-                text = enc.decode(tflex.backlog)
+              text = tflex.detokenizer.decode(tflex.tokens)
+              tflex.context_count += len(tflex.tokens)
+              if text:
                 result = text
                 if clear is not None:
                   result, *rest = text.split(clear)
                 sys.stdout.write(result)
                 sys.stdout.flush()
                 tflex.context_text += text
-                tflex.context_count += len(tflex.backlog)
                 def reset_context():
                   tflex.context_text = ""
                   tflex.context_count = 0
                   tflex.context_tokens = []
                   tflex.first = True
                   tflex.tokens = tflex.prompt_tokens[:]
+                  tflex.detokenizer.reset()
                 tflex.reset_context = reset_context
                 if maxlen > 0 and tflex.context_count > maxlen or clear is not None and clear in tflex.context_text:
                   tflex.reset_context()
-                tflex.backlog = []
-                tflex.backlog_count = 0
               tflex.check_commands()
               tflex.context_tokens.extend(tflex.tokens)
               while len(tflex.context_tokens) > length - step - 1:
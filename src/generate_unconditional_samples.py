@@ -23,7 +23,9 @@ def sample_model(
     temperature=1,
     top_k=0,
     top_p=0.0,
-    penalize=0
+    penalize=0,
+    cache_dtype=None,
+    allowed_tokens=None
 ):
     """
     Run the sample_model
@@ -48,6 +50,11 @@ def sample_model(
     :penalize=0.0 : Float value controlling "used" penalty. Implements repetition
      reduction (similar to CTRL) if set to a value > 0. A decent setting might be 0.85
      with temperature 0.3 and top_k 40.
+    :cache_dtype=None : Store the KV cache as float16, bfloat16 or int8 to fit
+     larger batches; None keeps the model dtype.
+    :allowed_tokens=None : Path to a file of allowed tokens: a .json list of
+     token ids or strings, or text whose tokens are all allowed. Generation
+     only considers those tokens, which also makes each step cheaper.
     """
     enc = encoder.get_encoder(model_name)
     hparams = model.default_hparams()
@@ -67,7 +74,9 @@ def sample_model(
             hparams=hparams, length=length,
             start_token=enc.encoder['<|endoftext|>'],
             batch_size=batch_size,
-            temperature=temperature, top_k=top_k, top_p=top_p, penalize=penalize
+            temperature=temperature, top_k=top_k, top_p=top_p, penalize=penalize,
+            cache_dtype=cache_dtype,
+            allowed_tokens=sample.load_allowed_tokens(enc, allowed_tokens) if allowed_tokens else None
         )[:, 1:]
 
         saver = tflex.Saver()
@@ -79,9 +88,10 @@ def sample_model(
         generated = 0
         while nsamples == 0 or generated < nsamples:
             out = sess.run(output)
+            texts = enc.decode_batch(out)
             for i in range(batch_size):
                 generated += 1
-                text = enc.decode(out[i])
+                text = texts[i]
                 print("=" * 40 + " SAMPLE " + str(generated) + " " + "=" * 40)
                 print(text)
 
@@ -12,7 +12,7 @@ import numpy as np
 import tensorflow as tf
 import tflex
 
-import model, sample, encoder
+import model, sample, encoder, constraints
 
 def interact_model(
     model_name='117M',
@@ -25,7 +25,10 @@ def interact_model(
     top_k=0,
     top_p=0.0,
     penalize=0,
-    prompt=None
+    prompt=None,
+    cache_dtype=None,
+    allowed_tokens=None,
+    constraint=None
 ):
     """
     Interactively run the model
@@ -49,6 +52,13 @@ def interact_model(
     :penalize=0.0 : Float value controlling "used" penalty. Implements repetition
      reduction (similar to CTRL) if set to a value > 0. A decent setting might be 0.85
      with temperature 0.3 and top_k 40.
+    :cache_dtype=None : Store the KV cache as float16, bfloat16 or int8 to fit
+     larger batches; None keeps the model dtype.
+    :allowed_tokens=None : Path to a file of allowed tokens: a .json list of
+     token ids or strings, or text whose tokens are all allowed. Generation
+     only considers those tokens, which also makes each step cheaper.
+    :constraint=None : Path to a .json list or a text file of phrases, one per
+     line; each sample is one of the phrases, followed by <|endoftext|>.
     """
     if batch_size is None:
         batch_size = 1
@@ -72,7 +82,10 @@ def interact_model(
             hparams=hparams, length=length,
             context=context,
             batch_size=batch_size,
-            temperature=temperature, top_k=top_k, top_p=top_p, penalize=penalize
+            temperature=temperature, top_k=top_k, top_p=top_p, penalize=penalize,
+            cache_dtype=cache_dtype,
+            allowed_tokens=sample.load_allowed_tokens(enc, allowed_tokens) if allowed_tokens else None,
+            constraint=constraints.load_constraint(enc, constraint) if constraint else None
         )
 
         saver = tflex.Saver()
@@ -101,9 +114,10 @@ def interact_model(
                 out = sess.run(output, feed_dict={
                     context: [context_tokens for _ in range(batch_size)]
                 })[:, len(context_tokens):]
+                texts = enc.decode_batch(out)
                 for i in range(batch_size):
                     generated += 1
-                    text = enc.decode(out[i])
+                    text = texts[i]
                     print("=" * 40 + " SAMPLE " + str(generated) + " " + "=" * 40)
                     sys.stdout.write(raw_text)
                     print(text)
@@ -1,11 +1,16 @@
+import collections
 import glob
+import hashlib
+import json
+import mmap
 import numpy as np
 import os
-import tensorflow as tf
 import tqdm
 
+import encoder
 
-def load_dataset(enc, path, combine):
+
+def dataset_paths(path):
     paths = []
     if os.path.isfile(path):
         # Simple file
@@ -18,29 +23,212 @@ def load_dataset(enc, path, combine):
     else:
         # Assume glob
         paths = glob.glob(path)
+    return paths
+
+
+def iter_chunks(paths, combine):
+    """Yields pre-encoded arrays and raw text chunks in dataset order.
 
-    token_chunks = []
+    Text files are concatenated with <|endoftext|> separators until the
+    pending text reaches `combine` characters."""
     raw_text = ''
     for path in tqdm.tqdm(paths):
         if path.endswith('.npz'):
             # Pre-encoded
             with np.load(path) as npz:
                 for item in npz.files:
-                    token_chunks.append(npz[item])
+                    yield npz[item]
         else:
             # Plain text
             with open(path, 'r') as fp:
                 raw_text += fp.read()
             if len(raw_text) >= combine:
-                tokens = np.stack(enc.encode(raw_text))
-                token_chunks.append(tokens)
+                yield raw_text
                 raw_text = ''
             else:
                 raw_text += '<|endoftext|>'
     if raw_text:
-        tokens = np.stack(enc.encode(raw_text))
-        token_chunks.append(tokens)
-    return token_chunks
+        yield raw_text
+
+
+def encode_chunk(text):
+    """Pool task for encode_chunks; the pool runs encoder.init_worker."""
+    return np.stack(encoder.worker_encode(text))
+
+
+def encode_chunks(enc, chunks, jobs=1):
+    """Encodes the text chunks from `iter_chunks`, preserving their order."""
+    if jobs <= 1 or not isinstance(enc, encoder.Encoder):
+        # the native tokenizer is already multithreaded; batch it instead
+        batch = []
+        for chunk in chunks:
+            if isinstance(chunk, np.ndarray):
+                yield from encode_text_batch(enc, batch)
+                batch = []
+                yield chunk
+            else:
+                batch.append(chunk)
+                if len(batch) >= max(1, jobs):
+                    yield from encode_text_batch(enc, batch)
+                    batch = []
+        yield from encode_text_batch(enc, batch)
+        return
+    import multiprocessing
+    with multiprocessing.Pool(jobs, initializer=encoder.init_worker, initargs=(enc,)) as pool:
+        # keep a bounded window of chunks in flight so huge corpora are not
+        # read into memory ahead of the encoders
+        def submit():
+            for chunk in chunks:
+                if isinstance(chunk, np.ndarray):
+                    yield chunk
+                else:
+                    yield pool.apply_async(encode_chunk, (chunk,))
+        yield from encoder.ordered_results(submit(), 2 * jobs)
+
+def encode_text_batch(enc, texts):
+    if len(texts) == 0:
+        return []
+    if len(texts) == 1:
+        return [np.stack(enc.encode(texts[0]))]
+    return [np.stack(tokens) for tokens in enc.encode_batch(texts, jobs=1)]
+
+
+def load_dataset(enc, path, combine, jobs=1, cache_dir=None):
+    manifest = read_manifest(path)
+    if manifest is not None:
+        return [np.load(shard)['arr_0'] for shard, _ in manifest]
+    if cache_dir:
+        return DatasetCache(cache_dir, enc, combine).load(dataset_paths(path), jobs=jobs)
+    chunks = iter_chunks(dataset_paths(path), combine)
+    return list(encode_chunks(enc, chunks, jobs=jobs))
+
+
+SEPARATOR = '<|endoftext|>'
+
+class DatasetCache(object):
+    """On-disk cache of encoded text chunks.
+
+    Chunks are grouped exactly as iter_chunks groups them and stored as
+    <key>.npy, where the key hashes the tokenizer, --combine and the
+    content of every file in the chunk. index.json records each file's
+    size, mtime, hash and length, so unchanged files are not reread and
+    only chunks with new or changed files are encoded again."""
+
+    def __init__(self, path, enc, combine):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.index_path = os.path.join(path, 'index.json')
+        try:
+            with open(self.index_path) as f:
+                self.files = json.load(f)
+        except (OSError, ValueError):
+            self.files = {}
+        # the backends share a fingerprint but split text differently
+        # (HighSpeedTokenizer encodes line by line), so key on both
+        tokenizer = '%s-%s' % (type(enc).__name__, getattr(enc, 'fingerprint', None))
+        self.prefix = '%s-%d' % (tokenizer, combine)
+        self.enc = enc
+        self.combine = combine
+
+    def file_info(self, path):
+        st = os.stat(path)
+        key = os.path.abspath(path)
+        info = self.files.get(key)
+        if info and info['size'] == st.st_size and info['mtime'] == st.st_mtime_ns:
+            return info
+        with open(path, 'r') as fp:
+            text = fp.read()
+        info = {
+            'size': st.st_size,
+            'mtime': st.st_mtime_ns,
+            'sha1': hashlib.sha1(text.encode('utf-8')).hexdigest(),
+            'chars': len(text),
+        }
+        self.files[key] = info
+        return info
+
+    def groups(self, paths):
+        """Yields pre-encoded arrays and (files, trailing_separator) groups."""
+        group = []
+        n = 0
+        for path in tqdm.tqdm(paths):
+            if path.endswith('.npz'):
+                with np.load(path) as npz:
+                    for item in npz.files:
+                        yield npz[item]
+                continue
+            group.append(path)
+            n += self.file_info(path)['chars']
+            if n >= self.combine:
+                yield group, False
+                group = []
+                n = 0
+            else:
+                n += len(SEPARATOR)
+        if group:
+            yield group, True
+
+    def key(self, files, trailing):
+        h = hashlib.sha1(self.prefix.encode('utf-8'))
+        for path in files:
+            h.update(self.files[os.path.abspath(path)]['sha1'].encode('utf-8'))
+        h.update(b'+' if trailing else b'-')
+        return h.hexdigest()
+
+    def chunk_path(self, key):
+        return os.path.join(self.path, key + '.npy')
+
+    def load(self, paths, jobs=1):
+        keys = collections.deque()
+        def chunks():
+            for item in self.groups(paths):
+                if isinstance(item, np.ndarray):
+                    keys.append(None)
+                    yield item
+                    continue
+                files, trailing = item
+                key = self.key(files, trailing)
+                if os.path.exists(self.chunk_path(key)):
+                    keys.append(None)
+                    yield np.load(self.chunk_path(key))
+                    continue
+                texts = []
+                for path in files:
+                    with open(path, 'r') as fp:
+                        texts.append(fp.read())
+                keys.append(key)
+                yield SEPARATOR.join(texts) + (SEPARATOR if trailing else '')
+        result = []
+        hits = 0
+        for tokens in encode_chunks(self.enc, chunks(), jobs=jobs):
+            key = keys.popleft()
+            if key is None:
+                hits += 1
+            else:
+                tmp = self.chunk_path(key) + '.%d.tmp' % os.getpid()
+                with open(tmp, 'wb') as f:
+                    np.save(f, tokens)
+                os.replace(tmp, self.chunk_path(key))
+            result.append(tokens)
+        print('Dataset cache: reused %d of %d chunks' % (hits, len(result)))
+        with open(self.index_path + '.tmp', 'w') as f:
+            json.dump(self.files, f)
+        os.replace(self.index_path + '.tmp', self.index_path)
+        return result
+
+
+MANIFEST = 'manifest.json'
+
+def read_manifest(path):
+    """Returns [(shard_path, token_count), ...] for a sharded encode.py output."""
+    if os.path.isdir(path):
+        path = os.path.join(path, MANIFEST)
+    if not path.endswith(MANIFEST) or not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        manifest = json.load(f)
+    base = os.path.dirname(path)
+    return [(os.path.join(base, shard['path']), shard['tokens']) for shard in manifest['shards']]
 
 
 def binary_search(f, lo, hi):
@@ -82,6 +270,15 @@ class Sampler(object):
                 within_chunk = index - self.boundaries[i]
                 return self.chunks[i][within_chunk:within_chunk + length]
 
+def sampler_state(sampler):
+    """JSON-serializable RNG state of any of the samplers here."""
+    name, keys, pos, has_gauss, cached_gaussian = sampler.rs.get_state()
+    return [name, keys.tolist(), int(pos), int(has_gauss), float(cached_gaussian)]
+
+def set_sampler_state(sampler, state):
+    name, keys, pos, has_gauss, cached_gaussian = state
+    sampler.rs.set_state((name, np.array(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian))
+
 def contbyte(b):
   n = ord(b)
   # https://en.wikipedia.org/wiki/UTF-8#Description
@@ -171,3 +368,75 @@ class TextSampler(object):
       if self.lock:
         self.lock.release()
 
+
+class MmapTextSampler(object):
+  """Samples token windows from a utf-8 text file without seeking.
+
+  The file is memory-mapped once; each sample snaps a random offset forward
+  to the next character (or line) boundary and decodes a single slice sized
+  from the running bytes-per-token estimate. Only the random draw is
+  serialized, so several threads may sample concurrently."""
+
+  def __init__(self, fp, enc, seed=None, verbose=False, snap='utf8', bytes_per_token=4.0):
+    if isinstance(fp, str):
+      fp = open(fp, 'rb')
+    self.fp = fp
+    self.mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    self.total_size = len(self.mm)
+    self.rs = np.random.RandomState(seed=seed)
+    self.enc = enc
+    self.verbose = verbose
+    assert snap in ['utf8', 'line']
+    self.snap = snap
+    self.bytes_per_token = bytes_per_token
+    self.lock = threading.Lock()
+
+  def boundary(self, index):
+    mm = self.mm
+    if self.snap == 'line':
+      found = mm.find(b'\n', index)
+      return self.total_size if found < 0 else found + 1
+    # skip at most three continuation bytes
+    for _ in range(3):
+      if index >= self.total_size or (mm[index] & 0xC0) != 0x80:
+        break
+      index += 1
+    return index
+
+  def grab_tokens(self, index, length):
+    start = self.boundary(index)
+    n = length + 4
+    size = int(n * self.bytes_per_token) + 16
+    while True:
+      end = min(start + size, self.total_size)
+      line = self.mm[start:end].decode('utf-8', errors='ignore').replace('\r', '')
+      tokens = self.enc.encode(line)
+      if len(tokens) >= n or end >= self.total_size:
+        break
+      size *= 2
+    if len(tokens) > 0:
+      # racy but harmless; it only sizes the next read
+      self.bytes_per_token = 0.9 * self.bytes_per_token + 0.1 * (end - start) / len(tokens)
+    # the slice ends mid-word, and unless we snapped to a line we also
+    # started mid-word, so drop a few tokens on either side.
+    if end < self.total_size:
+      tokens = tokens[:-1]
+    if self.snap != 'line':
+      tokens = tokens[3:]
+    return tokens, line
+
+  def sample(self, length):
+    attempts = 0
+    while True:
+      attempts += 1
+      if attempts > 10:
+        print('Could not sample from dataset; too small?')
+        return None
+      with self.lock:
+        index = self.rs.randint(0, self.total_size)
+      tokens, line = self.grab_tokens(index, length)
+      if len(tokens) >= length:
+        if self.verbose:
+          line = self.enc.decode(tokens)
+          print(repr(line))
+        return tokens[0:length]
@@ -11,9 +11,27 @@ def default_hparams():
         n_layer=12,
         res_dropout=0.0,
         attn_dropout=0.0,
-        dtype=tf.float32
+        dtype=tf.float32,
+        pad_vocab=0,
     )
 
+def padded_vocab(hparams):
+    """n_vocab rounded up to a multiple of hparams.pad_vocab (e.g. 64 or 128),
+    so the wte gather and logits matmul get aligned shapes."""
+    if not hparams.pad_vocab:
+        return hparams.n_vocab
+    return -(-hparams.n_vocab // hparams.pad_vocab) * hparams.pad_vocab
+
+def mask_padded_logits(logits, hparams):
+    """Pushes the logits of padding tokens to a large negative value, so
+    softmax, loss and sampling never select them."""
+    n_padded = padded_vocab(hparams)
+    if n_padded == hparams.n_vocab:
+        return logits
+    penalty = 65500 if logits.dtype != tf.float32 else 1e10
+    bias = np.where(np.arange(n_padded) < hparams.n_vocab, 0, -penalty)
+    return logits + tf.constant(bias, dtype=logits.dtype)
+
 import os
 
 def get_variable(name):
@@ -84,6 +102,7 @@ def attn(x, scope, n_state, *, past, hparams):
     assert x.shape.ndims == 3  # Should be [batch, sequence, features]
     assert n_state % hparams.n_head == 0
     if past is not None:
+        past = decompress_past(past, hparams.dtype if hparams else tf.float32)
         assert past.shape.ndims == 5  # Should be [batch, 2, heads, sequence, features], where 2 is [k, v]
 
     def split_heads(x):
@@ -156,6 +175,29 @@ def block(x, scope, *, past, hparams):
 def past_shape(*, hparams, batch_size=None, sequence=None):
     return [batch_size, hparams.n_layer, 2, hparams.n_head, sequence, hparams.n_embd // hparams.n_head]
 
+def compress_past(present, dtype):
+    """Converts present to KV cache storage. float16 and bfloat16 are plain
+    casts; int8 keeps one scale per head and position, and returns a
+    (values, scales) pair."""
+    dtype = tf.as_dtype(dtype)
+    if dtype == tf.int8:
+        x = tf.cast(present, tf.float32)
+        scales = tf.maximum(tf.reduce_max(tf.abs(x), axis=-1, keepdims=True) / 127.0, 1e-8)
+        return tf.cast(tf.round(x / scales), tf.int8), scales
+    return tf.cast(present, dtype)
+
+def decompress_past(past, dtype):
+    """Reverse of compress_past, upcasting to dtype."""
+    if isinstance(past, (tuple, list)):
+        values, scales = past
+        return tf.cast(tf.cast(values, tf.float32) * scales, dtype)
+    return tf.cast(past, dtype)
+
+def unstack_past(past, axis):
+    if isinstance(past, (tuple, list)):
+        return list(zip(*[tf.unstack(t, axis=axis) for t in past]))
+    return tf.unstack(past, axis=axis)
+
 def expand_tile(value, size):
     """Add a new axis of given size."""
     value = tf.convert_to_tensor(value, name='value')
@@ -168,7 +210,7 @@ def positions_for(tokens, past_length):
     return expand_tile(past_length + tf.range(nsteps), batch_size)
 
 
-def model(hparams, X, past=None, scope='model', reuse=tf.AUTO_REUSE):
+def model(hparams, X, past=None, scope='model', reuse=tf.AUTO_REUSE, vocab=None):
     dtype = hparams.dtype if hparams else tf.float32
     with tf.variable_scope(scope, reuse=reuse, dtype=dtype):
         results = {}
@@ -176,14 +218,14 @@ def model(hparams, X, past=None, scope='model', reuse=tf.AUTO_REUSE):
 
         wpe = get_variable('wpe') or tf.get_variable('wpe', [hparams.n_ctx, hparams.n_embd],
                              initializer=tf.random_normal_initializer(stddev=0.01, dtype=dtype))
-        wte = get_variable('wte') or tf.get_variable('wte', [hparams.n_vocab, hparams.n_embd],
+        wte = get_variable('wte') or tf.get_variable('wte', [padded_vocab(hparams), hparams.n_embd],
                              initializer=tf.random_normal_initializer(stddev=0.02, dtype=dtype))
-        past_length = 0 if past is None else tf.shape(past)[-2]
+        past_length = 0 if past is None else tf.shape(past[0] if isinstance(past, (tuple, list)) else past)[-2]
         h = tf.gather(wte, X) + tf.gather(wpe, positions_for(X, past_length))
 
         # Transformer
         presents = []
-        pasts = tf.unstack(past, axis=1) if past is not None else [None] * hparams.n_layer
+        pasts = unstack_past(past, axis=1) if past is not None else [None] * hparams.n_layer
         assert len(pasts) == hparams.n_layer
         for layer, past in enumerate(pasts):
             h, present = block(h, 'h%d' % layer, past=past, hparams=hparams)
@@ -195,7 +237,13 @@ def model(hparams, X, past=None, scope='model', reuse=tf.AUTO_REUSE):
 
         # Language model loss.  Do tokens <n predict token n?
         h_flat = tf.reshape(h, [batch*sequence, hparams.n_embd])
+        if vocab is not None:
+            # Only project onto the allowed token ids; logits[..., i] is the
+            # logit of token vocab[i].
+            logits = tf.matmul(h_flat, tf.gather(wte, vocab), transpose_b=True)
+            results['logits'] = tf.reshape(logits, [batch, sequence, shape_list(vocab)[0]])
+            return results
         logits = tf.matmul(h_flat, wte, transpose_b=True)
-        logits = tf.reshape(logits, [batch, sequence, hparams.n_vocab])
-        results['logits'] = logits
+        logits = tf.reshape(logits, [batch, sequence, padded_vocab(hparams)])
+        results['logits'] = mask_padded_logits(logits, hparams)
         return results
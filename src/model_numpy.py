@@ -0,0 +1,239 @@
+"""NumPy version of the forward pass in model.py, for CPU inference
+without building a TensorFlow graph.
+
+Parameters are a dict keyed like the TF variables without the 'model/'
+scope and ':0' suffix, e.g. params['h0/attn/c_attn/w']. Weights quantized
+by quantize_params are int8 with a float32 params[name + '/scale']."""
+
+import json
+import math
+import os
+import numpy as np
+
+import tflex_utils
+
+def load_params(path, dtype=np.float32):
+    """Loads weights from a .weights export, an .hdf5 checkpoint or a TF checkpoint.
+    A partial .hdf5 checkpoint is overlaid on the base checkpoint it names."""
+    base = None
+    if path.endswith('.weights') or os.path.isfile(path + '.weights'):
+        weights = tflex_utils.open_weights(path if path.endswith('.weights') else path + '.weights')
+    elif path.endswith('.hdf5') or os.path.isfile(path + '.hdf5'):
+        import h5py
+        weights = {}
+        with h5py.File(path if path.endswith('.hdf5') else path + '.hdf5', 'r') as f:
+            base = f.attrs.get('base')
+            def visit(name, dset):
+                if isinstance(dset, h5py.Dataset):
+                    value = dset[()]
+                    if dset.attrs.get('dtype') == 'bfloat16':
+                        value = (value.astype(np.uint32) << 16).view(np.float32)
+                    weights[name] = value
+            f.visititems(visit)
+    else:
+        from tensorflow.python import pywrap_tensorflow
+        reader = pywrap_tensorflow.NewCheckpointReader(path)
+        weights = {name: reader.get_tensor(name) for name in reader.get_variable_to_shape_map()}
+    params = {}
+    for name, value in weights.items():
+        name = name.split(':')[0]
+        if not name.startswith('model/'):
+            continue
+        value = np.asarray(value)
+        if value.dtype != dtype and value.dtype.kind == 'f':
+            value = value.astype(dtype)
+        params[name[len('model/'):]] = value
+    if base is not None:
+        # only some variables were saved; the rest come from the base model
+        base_params = load_params(base, dtype=dtype)
+        base_params.update(params)
+        params = base_params
+    return params
+
+def load_hparams(model_name):
+    hparams = {
+        'n_vocab': 50257,
+        'n_ctx': 1024,
+        'n_embd': 768,
+        'n_head': 12,
+        'n_layer': 12,
+    }
+    with open(os.path.join('models', model_name, 'hparams.json')) as f:
+        hparams.update(json.load(f))
+    return hparams
+
+def softmax(x, axis=-1):
+    x = x - np.max(x, axis=axis, keepdims=True)
+    ex = np.exp(x)
+    return ex / np.sum(ex, axis=axis, keepdims=True)
+
+def gelu(x):
+    return 0.5*x*(1+np.tanh(math.sqrt(2/math.pi)*(x+0.044715*np.power(x, 3))))
+
+def norm(x, g, b, *, axis=-1, epsilon=1e-5):
+    """Normalize to mean = 0, std = 1, then do a diagonal affine transform."""
+    u = np.mean(x, axis=axis, keepdims=True)
+    s = np.mean(np.square(x-u), axis=axis, keepdims=True)
+    x = (x - u) / np.sqrt(s + epsilon)
+    return x*g + b
+
+QUANTIZED = ('c_attn/w', 'c_proj/w', 'c_fc/w', 'wte')
+
+def quantize(w, axis=-1):
+    """Symmetric int8 quantization with one float32 scale per slice along axis."""
+    axis = axis % w.ndim
+    reduce = tuple(i for i in range(w.ndim) if i != axis)
+    amax = np.max(np.abs(w), axis=reduce, keepdims=True).astype(np.float32)
+    scale = np.where(amax > 0, amax / 127, 1).astype(np.float32)
+    q = np.clip(np.round(w / scale), -127, 127).astype(np.int8)
+    return q, scale.reshape([-1])
+
+def quantize_params(params):
+    """Quantizes conv1d weights per output channel and wte per token row;
+    each quantized name gets a companion name + '/scale'."""
+    result = {}
+    for name, value in params.items():
+        if name.endswith(QUANTIZED):
+            axis = 0 if name == 'wte' else -1
+            result[name], result[name + '/scale'] = quantize(value, axis=axis)
+        else:
+            result[name] = value
+    return result
+
+def matmul(x, w, scale=None, block=4096):
+    """x @ w, where w may be int8 with per-column scales. Dequantizes
+    `block` columns at a time so the float copy stays small."""
+    if scale is None:
+        return x @ w
+    out = np.empty([x.shape[0], w.shape[1]], dtype=x.dtype)
+    for i in range(0, w.shape[1], block):
+        out[:, i:i+block] = (x @ w[:, i:i+block].astype(x.dtype)) * scale[i:i+block]
+    return out
+
+def conv1d(x, params, scope):
+    *start, nx = x.shape
+    w = params[scope + '/w']
+    nf = w.shape[-1]
+    h = matmul(x.reshape([-1, nx]), w.reshape([nx, nf]), params.get(scope + '/w/scale'))
+    return (h + params[scope + '/b']).reshape(start + [nf])
+
+def embed(params, X):
+    wte = params['wte']
+    scale = params.get('wte/scale')
+    if scale is None:
+        return wte[X]
+    return wte[X].astype(params['wpe'].dtype) * scale[X][..., None]
+
+def unembed(params, h, block=4096):
+    """Logits against the tied wte rows."""
+    wte = params['wte']
+    scale = params.get('wte/scale')
+    if scale is None:
+        return h @ wte.T
+    *start, nx = h.shape
+    h = h.reshape([-1, nx])
+    out = np.empty([h.shape[0], wte.shape[0]], dtype=h.dtype)
+    for i in range(0, wte.shape[0], block):
+        out[:, i:i+block] = (h @ wte[i:i+block].astype(h.dtype).T) * scale[i:i+block]
+    return out.reshape(start + [wte.shape[0]])
+
+def split_heads(x, n_head):
+    # From [batch, sequence, features] to [batch, heads, sequence, features]
+    batch, seq, n = x.shape
+    return x.reshape([batch, seq, n_head, n // n_head]).transpose([0, 2, 1, 3])
+
+def merge_heads(x):
+    batch, heads, seq, n = x.shape
+    return x.transpose([0, 2, 1, 3]).reshape([batch, seq, heads*n])
+
+class KVCache(object):
+    """Preallocated keys and values for every layer, filled as tokens arrive.
+
+    Laid out like model.past_shape: [batch, layer, 2, heads, n_ctx, features]."""
+
+    def __init__(self, hparams, batch_size, dtype=np.float32):
+        n_head = hparams['n_head']
+        self.data = np.zeros([batch_size, hparams['n_layer'], 2, n_head, hparams['n_ctx'], hparams['n_embd'] // n_head], dtype=dtype)
+        self.length = 0
+
+    def present(self):
+        return self.data[:, :, :, :, :self.length]
+
+def attn(x, params, scope, *, hparams, cache=None, layer=0):
+    n_head = hparams['n_head']
+    c = conv1d(x, params, scope + '/c_attn')
+    q, k, v = [split_heads(t, n_head) for t in np.split(c, 3, axis=2)]
+    nd = q.shape[2]
+    if cache is not None:
+        start = cache.length
+        cache.data[:, layer, 0, :, start:start+nd] = k
+        cache.data[:, layer, 1, :, start:start+nd] = v
+        k = cache.data[:, layer, 0, :, :start+nd]
+        v = cache.data[:, layer, 1, :, :start+nd]
+    ns = k.shape[2]
+    w = q @ k.transpose([0, 1, 3, 2])
+    w = w * (1 / math.sqrt(v.shape[-1]))
+    # 1's in the lower triangle, counting from the lower right corner
+    mask = np.arange(nd)[:, None] >= np.arange(ns) - ns + nd
+    w = np.where(mask, w, w.dtype.type(-1e10))
+    a = merge_heads(softmax(w) @ v)
+    return conv1d(a, params, scope + '/c_proj')
+
+def mlp(x, params, scope):
+    h = gelu(conv1d(x, params, scope + '/c_fc'))
+    return conv1d(h, params, scope + '/c_proj')
+
+def block(x, params, scope, *, hparams, cache=None, layer=0):
+    a = attn(norm(x, params[scope + '/ln_1/g'], params[scope + '/ln_1/b']), params, scope + '/attn', hparams=hparams, cache=cache, layer=layer)
+    x = x + a
+    m = mlp(norm(x, params[scope + '/ln_2/g'], params[scope + '/ln_2/b']), params, scope + '/mlp')
+    return x + m
+
+def model(params, hparams, X, cache=None):
+    """Returns logits of shape [batch, sequence, n_vocab] for the tokens X.
+    With a KVCache, X continues the tokens already in the cache."""
+    X = np.asarray(X)
+    past_length = 0 if cache is None else cache.length
+    h = embed(params, X) + params['wpe'][past_length + np.arange(X.shape[1])]
+    for layer in range(hparams['n_layer']):
+        h = block(h, params, 'h%d' % layer, hparams=hparams, cache=cache, layer=layer)
+    if cache is not None:
+        cache.length += X.shape[1]
+    h = norm(h, params['ln_f/g'], params['ln_f/b'])
+    logits = unembed(params, h)
+    return logits[:, :, :hparams['n_vocab']]
+
+def top_k_logits(logits, k, epsilon=-1e10):
+    if k == 0 or k >= logits.shape[-1]:
+        return logits
+    kth = np.partition(logits, -k, axis=-1)[:, -k, None]
+    return np.where(logits < kth, epsilon, logits)
+
+def top_p_logits(logits, p, epsilon=-1e10):
+    logits_sort = -np.sort(-logits, axis=-1)
+    probs_sort = softmax(logits_sort)
+    probs_sums = np.cumsum(probs_sort, axis=-1) - probs_sort
+    logits_masked = np.where(probs_sums < p, logits_sort, 1000)
+    min_logits = np.min(logits_masked, axis=-1, keepdims=True)
+    return np.where(logits < min_logits, epsilon, logits)
+
+def sample_sequence(params, hparams, *, length, context, temperature=1, top_k=0, top_p=0.0, rng=None):
+    """Mirrors sample.sample_sequence: returns context followed by `length` sampled tokens."""
+    rng = rng or np.random
+    context = np.asarray(context)
+    if context.shape[1] + length > hparams['n_ctx']:
+        raise ValueError("Can't sample %d tokens after %d context tokens with a window size of %d" % (length, context.shape[1], hparams['n_ctx']))
+    cache = KVCache(hparams, context.shape[0], dtype=params['wpe'].dtype)
+    output = context
+    logits = model(params, hparams, context, cache=cache)[:, -1]
+    for _ in range(length):
+        logits = logits.astype(np.float64) / temperature
+        if top_p > 0.0:
+            logits = top_p_logits(logits, p=top_p)
+        else:
+            logits = top_k_logits(logits, k=top_k)
+        probs = softmax(logits)
+        samples = np.array([rng.choice(probs.shape[-1], p=row) for row in probs], dtype=output.dtype)
+        output = np.concatenate([output, samples[:, None]], axis=1)
+        logits = model(params, hparams, samples[:, None], cache=cache)[:, -1]
+    return output
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+sys.path += [os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')]
+sys.path += [os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))]
+
+import fire
+import time
+import numpy as np
+
+import tflex_utils
+import model_numpy, encoder
+from load_dataset import load_dataset
+
+def perplexity(params, hparams, tokens, *, batch_size=1):
+    """exp(mean next-token NLL) over consecutive n_ctx windows of tokens."""
+    n_ctx = hparams['n_ctx']
+    windows = [tokens[i:i+n_ctx] for i in range(0, len(tokens) - n_ctx + 1, n_ctx)]
+    if not windows:
+        raise ValueError('Need at least n_ctx=%d tokens to evaluate, got %d' % (n_ctx, len(tokens)))
+    total = 0.0
+    count = 0
+    for i in range(0, len(windows), batch_size):
+        batch = np.stack(windows[i:i+batch_size])
+        logits = model_numpy.model(params, hparams, batch[:, :-1]).astype(np.float64)
+        logits -= np.max(logits, axis=-1, keepdims=True)
+        logprobs = logits - np.log(np.sum(np.exp(logits), axis=-1, keepdims=True))
+        targets = batch[:, 1:]
+        total -= np.sum(np.take_along_axis(logprobs, targets[..., None], axis=-1))
+        count += targets.size
+    return float(np.exp(total / count))
+
+def tokens_per_second(params, hparams, *, length=32, batch_size=1, seed=0):
+    rng = np.random.RandomState(seed)
+    context = rng.randint(0, hparams['n_vocab'], size=[batch_size, 1])
+    start = time.time()
+    model_numpy.sample_sequence(params, hparams, length=length, context=context, top_k=40, rng=rng)
+    return batch_size * length / (time.time() - start)
+
+def nbytes(params):
+    return sum(np.asarray(value).nbytes for value in params.values())
+
+def quantize_weights(
+    model_name='117M',
+    restore_from=None,
+    out=None,
+    dataset=None,
+    combine=50000,
+    eval_tokens=32768,
+    batch_size=1,
+):
+    """
+    Quantize a checkpoint to int8 weights for model_numpy, and report the
+    perplexity regression against the float32 checkpoint
+    :model_name=117M : String, which model to use
+    :restore_from=None : Checkpoint or weights file; defaults to the latest
+     checkpoint in models/<model_name>
+    :out=None : Output path; defaults to models/<model_name>/model.int8.weights
+    :dataset=None : Text, npz or glob to evaluate perplexity on; if None,
+     only the size and speed are reported
+    :eval_tokens=32768 : Number of dataset tokens to evaluate
+    """
+    hparams = model_numpy.load_hparams(model_name)
+    if restore_from is None:
+        import tflex
+        restore_from = tflex.latest_checkpoint(os.path.join('models', model_name))
+    if out is None:
+        out = os.path.join('models', model_name, 'model.int8.weights')
+
+    print('Loading %s...' % restore_from)
+    params = model_numpy.load_params(restore_from)
+    quantized = model_numpy.quantize_params(params)
+    print('Writing %s...' % out)
+    tflex_utils.export_weights(out, [('model/' + name, value) for name, value in sorted(quantized.items())])
+    quantized = model_numpy.load_params(out)
+
+    print('Weights: %.1f MB float32, %.1f MB int8' % (nbytes(params) / 1e6, nbytes(quantized) / 1e6))
+    print('Speed: %.2f tokens/sec float32, %.2f tokens/sec int8' % (
+        tokens_per_second(params, hparams, batch_size=batch_size),
+        tokens_per_second(quantized, hparams, batch_size=batch_size)))
+    if dataset is None:
+        return
+    enc = encoder.get_encoder(model_name)
+    tokens = np.concatenate(load_dataset(enc, dataset, combine))[:eval_tokens]
+    base = perplexity(params, hparams, tokens, batch_size=batch_size)
+    ppl = perplexity(quantized, hparams, tokens, batch_size=batch_size)
+    print('Perplexity over %d tokens: %.4f float32, %.4f int8 (%+.2f%%)' % (len(tokens), base, ppl, 100 * (ppl / base - 1)))
+
+if __name__ == '__main__':
+    fire.Fire(quantize_weights)
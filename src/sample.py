@@ -1,3 +1,5 @@
+import json
+import numpy as np
 import tensorflow as tf
 
 import model
@@ -7,10 +9,12 @@ def penalize_used(logits, output, penalize=0.85):
     # I want to change the indices of logits wherever the index is found in output
     change_tensor = tf.zeros_like(logits, dtype=logits.dtype)
     unique = tf.unique(output[0])[0]
+    # ids mapped outside the logits (see allowed_tokens) are not penalized
+    unique = tf.boolean_mask(unique, unique >= 0)
     ones = tf.ones_like(unique, dtype=unique.dtype)
     indices = tf.expand_dims(unique, 1)
 
-    updates = tf.scatter_nd(indices, ones, [logits.shape[1]])
+    updates = tf.scatter_nd(indices, ones, tf.shape(logits)[1:])
 
     bool_tensor = tf.expand_dims(tf.cast(updates, tf.bool), 0)
 
@@ -50,19 +54,76 @@ def top_p_logits(logits, p, epsilon=-1e10):
         )
 
 
-def sample_sequence(*, hparams, length, start_token=None, batch_size=None, context=None, temperature=1, top_k=0, top_p=0.0, epsilon=-1e10, penalize=0.0):
+def sample_sequence(*, hparams, length, start_token=None, batch_size=None, context=None, temperature=1, top_k=0, top_p=0.0, epsilon=-1e10, penalize=0.0, cache_dtype=None, allowed_tokens=None, constraint=None):
     if start_token is None:
         assert context is not None, 'Specify exactly one of start_token and context!'
     else:
         assert context is None, 'Specify exactly one of start_token and context!'
         context = tf.fill([batch_size, 1], start_token)
 
+    if constraint is not None:
+        assert constraint.n_vocab == hparams.n_vocab, 'Constraint is over %d tokens, but the model has %d' % (constraint.n_vocab, hparams.n_vocab)
+        # constraints.Constraint tables: every transition as a sorted
+        # state * n_vocab + token key with its target state, and where each
+        # state's transitions start among the keys. Only the transitions are
+        # embedded in the graph; masks are scattered from them per step.
+        offsets, keys, next_states = constraint.compile()
+        if allowed_tokens is not None:
+            # every token the constraint can step on must be in the subset,
+            # or a state could be left with nothing to sample
+            if isinstance(allowed_tokens, tf.Tensor):
+                raise ValueError('allowed_tokens must be a list or array when combined with a constraint')
+            allowed_tokens = np.union1d(np.asarray(allowed_tokens, dtype=np.int64), keys % constraint.n_vocab)
+
+    if allowed_tokens is not None:
+        # Project onto and sample from these token ids only; logits index
+        # into allowed_tokens, and positions maps a token id back to its
+        # index there, or -1.
+        allowed_tokens = tf.convert_to_tensor(allowed_tokens, dtype=tf.int32)
+        positions = tf.scatter_nd(
+            allowed_tokens[:, tf.newaxis],
+            tf.range(1, tf.size(allowed_tokens) + 1),
+            [hparams.n_vocab]) - 1
+
+    if constraint is not None:
+        offsets = tf.constant(offsets)
+        keys = tf.constant(keys)
+        next_states = tf.constant(next_states)
+
+    def constraint_mask(state):
+        # [batch, n_vocab] bool mask of the tokens each row's state allows
+        start = tf.gather(offsets, state)
+        count = tf.gather(offsets, state + 1) - start
+        width = tf.reduce_max(count)
+        valid = tf.sequence_mask(count, width)
+        index = tf.boolean_mask(start[:, tf.newaxis] + tf.range(width)[tf.newaxis, :], valid)
+        rows = tf.boolean_mask(tf.tile(tf.range(tf.size(state))[:, tf.newaxis], [1, width]), valid)
+        tokens = tf.cast(tf.gather(keys, index) % constraint.n_vocab, tf.int32)
+        mask = tf.scatter_nd(tf.stack([rows, tokens], axis=1), tf.ones_like(tokens), [tf.size(state), constraint.n_vocab]) > 0
+        if allowed_tokens is not None:
+            mask = tf.gather(mask, allowed_tokens, axis=1)
+        return mask
+
+    def compress(presents):
+        # Store the KV cache as cache_dtype; model.attn upcasts it again.
+        if cache_dtype is None:
+            return presents
+        return model.compress_past(presents, cache_dtype)
+
+    def cache_shape():
+        shape = tf.TensorShape(model.past_shape(hparams=hparams, batch_size=batch_size))
+        if cache_dtype is not None and tf.as_dtype(cache_dtype) == tf.int8:
+            return (shape, shape[:-1].concatenate([1]))
+        return shape
+
     def step(hparams, tokens, past=None):
-        lm_output = model.model(hparams=hparams, X=tokens, past=past, reuse=tf.AUTO_REUSE)
+        lm_output = model.model(hparams=hparams, X=tokens, past=past, reuse=tf.AUTO_REUSE, vocab=allowed_tokens)
         if hparams.dtype != tf.float32:
             lm_output["logits"] = tf.cast(lm_output["logits"], tf.float32)
 
-        logits = lm_output['logits'][:, :, :hparams.n_vocab]
+        logits = lm_output['logits']
+        if allowed_tokens is None:
+            logits = logits[:, :, :hparams.n_vocab]
         presents = lm_output['present']
         presents.set_shape(model.past_shape(hparams=hparams, batch_size=batch_size))
         return {
@@ -76,39 +137,72 @@ def sample_sequence(*, hparams, length, start_token=None, batch_size=None, conte
         # rather than leaving the last token transformer calculation to the while loop.
         context_output = step(hparams, context[:, :-1])
 
-        def body(past, prev, output):
+        def body(past, prev, output, state):
             next_outputs = step(hparams, prev[:, tf.newaxis], past=past)
             logits = next_outputs['logits'][:, -1, :]  / tf.to_float(temperature)
             if penalize > 0.0:
-                logits = penalize_used(logits, output, penalize=penalize)
+                used = output if allowed_tokens is None else tf.gather(positions, output)
+                logits = penalize_used(logits, used, penalize=penalize)
+            if constraint is not None:
+                logits = tf.where(constraint_mask(state), logits, tf.ones_like(logits) * epsilon)
             if top_p > 0.0:
                 logits = top_p_logits(logits, p=top_p, epsilon=epsilon)
             else:
-                logits = top_k_logits(logits, k=top_k, epsilon=epsilon)
+                k = top_k if allowed_tokens is None or top_k == 0 else tf.minimum(top_k, tf.size(allowed_tokens))
+                logits = top_k_logits(logits, k=k, epsilon=epsilon)
             samples = tf.multinomial(logits, num_samples=1, output_dtype=tf.int32)
+            if allowed_tokens is not None:
+                samples = tf.gather(allowed_tokens, samples)
+            if constraint is not None:
+                key = tf.cast(state, tf.int64) * constraint.n_vocab + tf.cast(samples[:, 0], tf.int64)
+                index = tf.searchsorted(keys[tf.newaxis, :], key[tf.newaxis, :])[0]
+                state = tf.gather(next_states, index)
             return [
-                tf.concat([past, next_outputs['presents']], axis=-2),
+                tf.nest.map_structure(lambda a, b: tf.concat([a, b], axis=-2), past, compress(next_outputs['presents'])),
                 tf.squeeze(samples, axis=[1]),
                 tf.concat([output, samples], axis=1),
+                state,
             ]
 
         def cond(*args):
             return True
 
-        _, _, tokens = tf.while_loop(
+        _, _, tokens, _ = tf.while_loop(
             cond=cond, body=body,
             maximum_iterations=length,
             loop_vars=[
-                context_output['presents'],
+                compress(context_output['presents']),
                 context[:, -1],
                 context,
+                tf.zeros_like(context[:, -1]),
             ],
             shape_invariants=[
-                tf.TensorShape(model.past_shape(hparams=hparams, batch_size=batch_size)),
+                cache_shape(),
                 tf.TensorShape([batch_size]),
                 tf.TensorShape([batch_size, None]),
+                tf.TensorShape([batch_size]),
             ],
             back_prop=False,
         )
 
         return tokens
+
+def load_allowed_tokens(enc, path):
+    """Reads an allowed token set for sample_sequence. A .json file holds a
+    list of token ids and/or strings, and each string adds the ids it
+    encodes to; any other file adds every id its text encodes to."""
+    if path.endswith('.json'):
+        with open(path) as f:
+            items = json.load(f)
+    else:
+        with open(path, encoding='utf-8') as f:
+            items = [f.read()]
+    tokens = set()
+    for item in items:
+        if isinstance(item, int):
+            tokens.add(item)
+        elif enc.token_to_id(item) is not None:
+            tokens.add(enc.token_to_id(item))
+        else:
+            tokens.update(enc.encode(item))
+    return np.array(sorted(tokens), dtype=np.int32)
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+sys.path += [os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')]
+sys.path += [os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))]
+
+import fire
+import json
+import numpy as np
+import tensorflow as tf
+import tflex
+import tqdm
+
+import model, encoder
+
+class Scorer(object):
+    """Log-probabilities of token sequences under model.model.
+
+    score_texts scores whole texts, each starting after <|endoftext|>.
+    score_candidates runs a shared context once, then scores every
+    candidate continuation from its `past`."""
+
+    def __init__(self, sess, hparams, *, batch_size=32, bucket=32):
+        self.sess = sess
+        self.hparams = hparams
+        self.batch_size = batch_size
+        self.bucket = bucket
+        n_vocab = hparams.n_vocab
+
+        def token_logprobs(logits, labels, lengths):
+            logits = tf.cast(logits[:, :, :n_vocab], tf.float32)
+            logprobs = -tf.nn.sparse_softmax_cross_entropy_with_logits(labels=labels, logits=logits)
+            return logprobs * tf.sequence_mask(lengths, tf.shape(labels)[1], dtype=tf.float32)
+
+        self.tokens = tf.placeholder(tf.int32, [None, None])
+        self.lengths = tf.placeholder(tf.int32, [None])
+
+        # Whole texts: token n is predicted from tokens < n.
+        logits = model.model(hparams=hparams, X=self.tokens)['logits']
+        self.text_logprobs = token_logprobs(logits[:, :-1], self.tokens[:, 1:], self.lengths - 1)
+
+        # Shared context: computed once, then fed back in as `past`.
+        self.context = tf.placeholder(tf.int32, [1, None])
+        output = model.model(hparams=hparams, X=self.context)
+        self.context_present = output['present']
+        self.context_logits = output['logits'][:, -1]
+
+        # Candidates: the first token is predicted from the context's last logits.
+        self.past = tf.placeholder(hparams.dtype, model.past_shape(hparams=hparams, batch_size=1))
+        self.last_logits = tf.placeholder(hparams.dtype, [1, None])
+        batch = tf.shape(self.tokens)[0]
+        output = model.model(hparams=hparams, X=self.tokens, past=tf.tile(self.past, [batch, 1, 1, 1, 1, 1]))
+        logits = tf.concat([tf.tile(self.last_logits[:, tf.newaxis], [batch, 1, 1]), output['logits'][:, :-1]], axis=1)
+        self.candidate_logprobs = token_logprobs(logits, self.tokens, self.lengths)
+
+    def batches(self, sequences, max_length):
+        """Yields (indices, tokens, lengths), sorting by length so each batch
+        only pads to its longest member, rounded up to the bucket size."""
+        order = sorted(range(len(sequences)), key=lambda i: len(sequences[i]))
+        for start in range(0, len(order), self.batch_size):
+            indices = order[start:start + self.batch_size]
+            longest = max(1, max(len(sequences[i]) for i in indices))
+            width = min(-(-longest // self.bucket) * self.bucket, max_length)
+            tokens = np.zeros([len(indices), width], dtype=np.int32)
+            lengths = np.zeros([len(indices)], dtype=np.int32)
+            for row, i in enumerate(indices):
+                tokens[row, :len(sequences[i])] = sequences[i]
+                lengths[row] = len(sequences[i])
+            yield indices, tokens, lengths
+
+    def results(self, logprobs, lengths):
+        return [logprobs[row, :n].tolist() for row, n in enumerate(lengths)]
+
+    def score_texts(self, sequences):
+        """sequences are token lists that already start with <|endoftext|>;
+        returns the log-probs of every token after it."""
+        scores = [None] * len(sequences)
+        for indices, tokens, lengths in self.batches(sequences, self.hparams.n_ctx):
+            logprobs = self.sess.run(self.text_logprobs, feed_dict={self.tokens: tokens, self.lengths: lengths})
+            for i, values in zip(indices, self.results(logprobs, lengths - 1)):
+                scores[i] = values
+        return scores
+
+    def score_candidates(self, context, candidates):
+        present, last_logits = self.sess.run((self.context_present, self.context_logits), feed_dict={self.context: [context]})
+        scores = [None] * len(candidates)
+        for indices, tokens, lengths in self.batches(candidates, self.hparams.n_ctx - len(context)):
+            logprobs = self.sess.run(self.candidate_logprobs, feed_dict={
+                self.tokens: tokens, self.lengths: lengths, self.past: present, self.last_logits: last_logits})
+            for i, values in zip(indices, self.results(logprobs, lengths)):
+                scores[i] = values
+        return scores
+
+def read_records(path, window):
+    """Yields lists of up to `window` parsed JSONL records."""
+    with (sys.stdin if path == '-' else open(path, encoding='utf-8')) as f:
+        records = []
+        for line in f:
+            if line.strip():
+                records.append(json.loads(line))
+            if len(records) >= window:
+                yield records
+                records = []
+        if records:
+            yield records
+
+def summarize(logprobs, truncated, per_token):
+    result = {'logprob': float(np.sum(logprobs)), 'tokens': len(logprobs)}
+    if truncated:
+        result['truncated'] = True
+    if per_token:
+        result['token_logprobs'] = logprobs
+    return result
+
+def score(
+    input='-',
+    output='-',
+    model_name='117M',
+    restore_from=None,
+    batch_size=32,
+    bucket=32,
+    window=4096,
+    per_token=False,
+):
+    """
+    Score texts or candidate completions from JSONL, writing one JSON line per input line
+    :input=- : JSONL path, or - for stdin. Each line has either "text", or
+     "context" plus "candidates" (a list of completions of that context)
+    :output=- : JSONL path, or - for stdout. Each input record is copied
+     with "logprob" (total) and "tokens" added, or a "scores" list of those
+     for candidates
+    :batch_size=32 : Sequences per batch
+    :bucket=32 : Batches are padded to a multiple of this many tokens
+    :window=4096 : Records read at a time; texts are bucketed by length
+     within a window
+    :per_token=False : Also write the log-prob of every token
+    """
+    enc = encoder.get_encoder(model_name)
+    hparams = model.default_hparams()
+    with open(os.path.join('models', model_name, 'hparams.json')) as f:
+        hparams.override_from_dict(json.load(f))
+    if restore_from is None:
+        restore_from = os.path.join('models', model_name)
+    end = enc.token_to_id('<|endoftext|>')
+
+    with tflex.Session(graph=tf.Graph()) as sess:
+        scorer = Scorer(sess, hparams, batch_size=batch_size, bucket=bucket)
+        saver = tflex.Saver()
+        saver.restore(sess, tflex.latest_checkpoint(restore_from) if os.path.isdir(restore_from) else restore_from)
+
+        out = sys.stdout if output == '-' else open(output, 'w', encoding='utf-8')
+        try:
+            for records in tqdm.tqdm(read_records(input, window), disable=output == '-'):
+                texts = [i for i, record in enumerate(records) if 'text' in record]
+                sequences = [[end] + tokens for tokens in enc.encode_batch([records[i]['text'] for i in texts])]
+                scores = scorer.score_texts([tokens[:hparams.n_ctx] for tokens in sequences])
+                for i, tokens, logprobs in zip(texts, sequences, scores):
+                    records[i].update(summarize(logprobs, len(tokens) > hparams.n_ctx, per_token))
+                for record in records:
+                    if 'text' in record:
+                        continue
+                    if 'candidates' not in record:
+                        raise ValueError('Each record needs "text", or "context" and "candidates": %r' % record)
+                    context = ([end] + enc.encode(record.get('context', '')))[-(hparams.n_ctx - 1):]
+                    candidates = enc.encode_batch(record['candidates'])
+                    room = hparams.n_ctx - len(context)
+                    scores = scorer.score_candidates(context, [tokens[:room] for tokens in candidates])
+                    record['scores'] = [summarize(logprobs, len(tokens) > room, per_token) for tokens, logprobs in zip(candidates, scores)]
+                for record in records:
+                    out.write(json.dumps(record) + '\n')
+                out.flush()
+        finally:
+            if out is not sys.stdout:
+                out.close()
+
+if __name__ == '__main__':
+    fire.Fire(score)
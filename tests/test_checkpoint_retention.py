@@ -0,0 +1,53 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+pytest.importorskip('tensorflow')
+
+import tflex
+
+HOUR = 3600
+
+def simulate(retention, hours):
+  """Saves one checkpoint an hour, enforcing retention after each save the
+  way Saver.finish does, and returns the counters left on disk."""
+  checkpoints = []
+  for counter in range(hours + 1):
+    checkpoints.append((counter, 'model-%d.hdf5' % counter, counter * HOUR, 1))
+    deleted = set(retention.select(checkpoints))
+    checkpoints = [c for c in checkpoints if c[1] not in deleted]
+  return [c[0] for c in checkpoints]
+
+def test_keeps_one_checkpoint_every_n_hours_across_passes():
+  retention = tflex.CheckpointRetention(max_to_keep=3, keep_checkpoint_every_n_hours=2)
+  assert simulate(retention, 24) == [0, 2, 4, 6, 8, 10, 12, 14, 16, 18, 20, 22, 23, 24]
+
+def test_default_hours_keep_nothing_extra():
+  retention = tflex.CheckpointRetention(max_to_keep=3, keep_checkpoint_every_n_hours=10000.0)
+  assert simulate(retention, 24) == [22, 23, 24]
+
+def test_zero_hours_keep_nothing_extra():
+  retention = tflex.CheckpointRetention(max_to_keep=3, keep_checkpoint_every_n_hours=0)
+  assert simulate(retention, 24) == [22, 23, 24]
+
+def test_max_bytes_keeps_newest():
+  retention = tflex.CheckpointRetention(max_to_keep=5, max_bytes=2)
+  checkpoints = [(i, 'model-%d.hdf5' % i, i, 1) for i in range(5)]
+  assert retention.select(checkpoints) == ['model-0.hdf5', 'model-1.hdf5', 'model-2.hdf5']
+
+def test_keeps_base_of_partial_checkpoints(tmp_path):
+  h5py = pytest.importorskip('h5py')
+  retention = tflex.CheckpointRetention(max_to_keep=2)
+  base = str(tmp_path / 'model-1')
+  for counter in range(1, 6):
+    path = str(tmp_path / ('model-%d.hdf5' % counter))
+    with h5py.File(path, 'w') as f:
+      f['x'] = [1.0]
+      if counter > 1:
+        f.attrs['base'] = base
+    os.utime(path, (counter, counter))
+    retention.enforce(path)
+    retention.wait()
+  assert sorted(os.listdir(str(tmp_path))) == ['model-1.hdf5', 'model-4.hdf5', 'model-5.hdf5']
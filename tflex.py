@@ -6,15 +6,22 @@ import sys
 import re
 from tensorflow.python import pywrap_tensorflow
 import tqdm
-import h5py
+import json
+from tflex_utils import open_weights
 import shutil
 import tempfile
 import math
+import threading
+import queue
+import time
+import collections
+import concurrent.futures
 
-from tensorflow.contrib import tpu
-from tensorflow.contrib.cluster_resolver import TPUClusterResolver
+# tensorflow.contrib.tpu, the cluster resolver and h5py are slow to import,
+# so they are only loaded by the functions that need them.
 
 def get_tpu_addr(tpu_name=None):
+    from tensorflow.contrib.cluster_resolver import TPUClusterResolver
     # Get the TPU's location
     if tpu_name is not None:
       return TPUClusterResolver(tpu_name).get_master()
@@ -39,6 +46,7 @@ class Session(tf.Session):
     sess = super().__enter__()
     if self.init_tpu:
       print("Initializing TPU...")
+      from tensorflow.contrib import tpu
       sess.run(tpu.initialize_system())
     return sess
 
@@ -57,14 +65,36 @@ def split_by_params(vs, n=200e6, f=None):
       i = 0
   yield xs
 
+CHECKPOINT_RE = re.compile(r'^model-([0-9]+)(?:-[0-9]+)?[.](?:npy|hdf5)$')
+
+_latest_checkpoints = {}
+
 def latest_checkpoint(checkpoint_dir, latest_filename=None):
-  paths = [x for x in glob(os.path.join(checkpoint_dir, 'model-*.*')) if not x.endswith(".tmp")]
-  ctrs = np.array([[int(y) for y in re.findall(r'model-([0-9]+)(?:-[0-9]+)?[.](?:npy|hdf5)', x)] for x in paths]).flatten()
-  if len(ctrs) <= 0:
+  # one scandir per directory change; empty (truncated) files are skipped
+  try:
+    mtime = os.stat(checkpoint_dir).st_mtime_ns
+  except OSError:
+    mtime = None
+  key = (checkpoint_dir, latest_filename)
+  cached = _latest_checkpoints.get(key)
+  if mtime is not None and cached is not None and cached[0] == mtime:
+    return cached[1]
+  ctr = -1
+  if mtime is not None and os.path.isdir(checkpoint_dir):
+    with os.scandir(checkpoint_dir) as entries:
+      for entry in entries:
+        m = CHECKPOINT_RE.match(entry.name)
+        if m and int(m.group(1)) > ctr and entry.stat().st_size > 0:
+          ctr = int(m.group(1))
+  if ctr < 0 and os.path.isfile(os.path.join(checkpoint_dir, 'model.weights')):
+    ckpt = os.path.join(checkpoint_dir, 'model.weights')
+  elif ctr < 0:
     ckpt = tf.train.latest_checkpoint(checkpoint_dir, latest_filename=latest_filename)
-    return ckpt
-  ctr = ctrs.max()
-  return os.path.join(checkpoint_dir, 'model-{}').format(ctr)
+  else:
+    ckpt = os.path.join(checkpoint_dir, 'model-{}').format(ctr)
+  if mtime is not None:
+    _latest_checkpoints[key] = (mtime, ckpt)
+  return ckpt
 
 def truncate_value(variable, value, reshape=True):
   if not reshape:
@@ -74,6 +104,15 @@ def truncate_value(variable, value, reshape=True):
   params2 = np.prod(value.shape)
   if params == params2:
     return value
+  if variable.name.split(':')[0].endswith('/wte') and len(shape) == value.ndim == 2 and shape[1] == value.shape[1]:
+    # wte with and without a padded vocabulary: keep the token rows both
+    # have and zero any new ones
+    print('Resizing {} from shape {} to shape {}'.format(variable.name, value.shape, shape))
+    sys.stdout.flush()
+    rows = np.zeros(shape, dtype=value.dtype)
+    n = min(shape[0], value.shape[0])
+    rows[:n] = value[:n]
+    return rows
   if params2 > params:
     print('Truncating {} from shape {} to shape {}'.format(variable.name, value.shape, shape))
     sys.stdout.flush()
@@ -87,7 +126,7 @@ def truncate_value(variable, value, reshape=True):
     value = np.array(value)
     value = value.reshape([-1])
     n = math.ceil(params / params2)
-    value = np.tile(value, n)
+    value = np.tile(value, n)[0:params]
     value = value.reshape(shape)
   return value
 
@@ -106,13 +145,64 @@ def assign_values(variables, values, session=None):
   #  print(x.name, x.shape.as_list(), k, v.shape)
   session.run(ops, vals)
 
-def load_snapshot(ckpt, session=None, var_list=None, reshape=False):
+def variable_bytes(variable):
+  # checkpoints hold float32 regardless of the variable's dtype
+  return 4 * int(np.prod(variable.shape.as_list()))
+
+def restore_values(variables, read, session=None, threads=8, max_bytes=1<<30):
+  """Reads variable values with `read(variable)` on a thread pool and
+  assigns them group by group. Each group holds at most half of
+  `max_bytes`, and the next group is read while the current one is
+  assigned, so at most `max_bytes` of values are in memory at once.
+  Returns the time spent in each phase."""
   session = session or tf.get_default_session()
+  timings = collections.OrderedDict([('read', 0.0), ('wait', 0.0), ('assign', 0.0), ('total', 0.0)])
+  start = time.time()
+  def timed_read(variable):
+    t0 = time.time()
+    value = read(variable)
+    return value, time.time() - t0
+  groups = []
+  inflight = 0
+  for variable in variables:
+    size = variable_bytes(variable)
+    if not groups or (groups[-1] and inflight + size > max_bytes // 2):
+      groups.append([])
+      inflight = 0
+    groups[-1].append(variable)
+    inflight += size
+  with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool, tqdm.tqdm(total=len(variables)) as progress:
+    def submit(group):
+      return [(variable, pool.submit(timed_read, variable)) for variable in group]
+    pending = submit(groups[0]) if groups else []
+    for i in range(len(groups)):
+      t0 = time.time()
+      values = []
+      for variable, future in pending:
+        value, elapsed = future.result()
+        timings['read'] += elapsed
+        values.append(value)
+      t1 = time.time()
+      # start reading the next group before this one is assigned
+      following = submit(groups[i + 1]) if i + 1 < len(groups) else []
+      assign_values([variable for variable, future in pending], values, session=session)
+      t2 = time.time()
+      timings['wait'] += t1 - t0
+      timings['assign'] += t2 - t1
+      progress.update(len(pending))
+      pending = following
+  timings['total'] = time.time() - start
+  print('Restored %d variables in %.2fs (read %.2fs over %d threads, waited %.2fs, assigned %.2fs)' % (
+    len(variables), timings['total'], timings['read'], threads, timings['wait'], timings['assign']))
+  return timings
+
+def load_snapshot(ckpt, session=None, var_list=None, reshape=False, threads=8, max_bytes=1<<30):
   reader = pywrap_tensorflow.NewCheckpointReader(ckpt)
   vs = var_list or tf.trainable_variables()
-  for variables in tqdm.tqdm(list(split_by_params(vs))):
-    values = [value for variable, value in grab_values(variables, reader, reshape=reshape)]
-    assign_values(variables, values, session=session)
+  def read(variable):
+    value = reader.get_tensor(variable.name.split(':')[0])
+    return truncate_value(variable, value, reshape=reshape)
+  return restore_values(vs, read, session=session, threads=threads, max_bytes=max_bytes)
 
 def get_variable(name, var_list=None):
   name, num = name.split(':') if ':' in name else (name, '0')
@@ -136,13 +226,72 @@ def load_weights(ckpt, session=None, var_list=None, reshape=False):
         value = truncate_value(variable, value, reshape=reshape)
         variable.load(value, session)
 
-def load_variables(ckpt, session=None, var_list=None, reshape=False):
-  session = session or tf.get_default_session()
+def to_bfloat16(value):
+  """Rounds float32 values to bfloat16, returned as their uint16 bit patterns."""
+  bits = np.asarray(value, dtype=np.float32).view(np.uint32)
+  bits = bits + (0x7FFF + ((bits >> 16) & 1))
+  return (bits >> 16).astype(np.uint16)
+
+def from_bfloat16(bits):
+  return (np.asarray(bits, dtype=np.uint32) << 16).view(np.float32)
+
+def read_dataset(dset):
+  """Reads an HDF5 checkpoint tensor as float32, whatever it was stored as."""
+  value = dset[()]
+  if dset.attrs.get('dtype') == 'bfloat16':
+    return from_bfloat16(value)
+  return value.astype(np.float32, copy=False)
+
+def load_variables(ckpt, session=None, var_list=None, reshape=False, threads=8, max_bytes=1<<30):
   vs = var_list or tf.trainable_variables()
+  import h5py
   with h5py.File(ckpt, "r") as f:
-    for variables in tqdm.tqdm(list(split_by_params(vs))):
-      values = [truncate_value(x, f[x.name], reshape=reshape)  for x in variables]
-      assign_values(variables, values, session=session)
+    base = f.attrs.get('base')
+    if base is not None:
+      # only some variables were saved; the rest come from the base model
+      missing = [x for x in vs if x.name not in f]
+      vs = [x for x in vs if x.name in f]
+      if missing:
+        print('Loading %d variables from base checkpoint %s' % (len(missing), base))
+        restore_checkpoint(base, session=session, var_list=missing, reshape=reshape, threads=threads, max_bytes=max_bytes)
+    def read(variable):
+      return truncate_value(variable, read_dataset(f[variable.name]), reshape=reshape)
+    return restore_values(vs, read, session=session, threads=threads, max_bytes=max_bytes)
+
+def load_mapped(path, session=None, var_list=None, reshape=False, threads=8, max_bytes=1<<30):
+  vs = var_list or tf.trainable_variables()
+  weights = open_weights(path)
+  def read(variable):
+    return truncate_value(variable, weights[variable.name], reshape=reshape)
+  return restore_values(vs, read, session=session, threads=threads, max_bytes=max_bytes)
+
+def checkpoint_base(ckpt):
+  """Returns the checkpoint a partial checkpoint builds on, or ckpt itself."""
+  path = ckpt if ckpt.endswith('.hdf5') else ckpt + '.hdf5'
+  if not os.path.isfile(path):
+    return ckpt
+  import h5py
+  with h5py.File(path, "r") as f:
+    return f.attrs.get('base', ckpt)
+
+def checkpoint_key(ckpt):
+  """Normalizes a checkpoint path, with or without .hdf5, for comparison."""
+  return os.path.abspath(re.sub(r'[.]hdf5$', '', ckpt))
+
+def restore_checkpoint(save_path, session=None, var_list=None, reshape=False, threads=8, max_bytes=1<<30):
+  options = dict(threads=threads, max_bytes=max_bytes)
+  if save_path.endswith('.weights'):
+    load_mapped(save_path, session=session, var_list=var_list, reshape=reshape, **options)
+  elif save_path.endswith('.ckpt') or os.path.isfile(save_path + '.data-00000-of-00001'):
+    load_snapshot(save_path, session=session, var_list=var_list, reshape=reshape, **options)
+  elif save_path.endswith('.hdf5'):
+    load_variables(save_path, session=session, var_list=var_list, reshape=reshape, **options)
+  elif os.path.exists(save_path + '.npy') or os.path.exists(save_path + '-0.npy'):
+    load_weights(save_path, session=session, var_list=var_list, reshape=reshape)
+  elif os.path.exists(save_path + '.hdf5'):
+    load_variables(save_path + '.hdf5', session=session, var_list=var_list, reshape=reshape, **options)
+  else:
+    raise Exception("Can't load checkpoint %s" % save_path)
 
 def maketree(path):
     try:
@@ -150,23 +299,207 @@ def maketree(path):
     except:
         pass
 
-def save_variables(ckpt, session=None, var_list=None):
+def snapshot_variables(session=None, var_list=None):
+    """Copies variable values into host memory as [(name, value), ...]."""
     session = session or tf.get_default_session()
     vs = var_list or tf.trainable_variables()
+    snapshot = []
+    for variables in split_by_params(vs):
+      values = session.run(variables)
+      snapshot.extend(zip([x.name for x in variables], values))
+    return snapshot
+
+def write_variables(ckpt, snapshot, dtype=None, compression=None, base=None):
+    """Writes a snapshot to HDF5.
+
+    dtype is the storage type: float32 (default), float16 or bfloat16
+    (kept as uint16 bit patterns). compression is an h5py filter such as
+    'gzip' or 'lzf'. base names the checkpoint that provides any variable
+    missing from this one."""
     maketree(os.path.dirname(ckpt))
     fname = ckpt+'.tmp'
+    import h5py
     with h5py.File(fname, "w") as f:
-      for variables in tqdm.tqdm(list(split_by_params(vs))):
-        values = session.run(variables)
-        for value, variable in zip(values, variables):
-          name = variable.name
-          shape = variable.shape.as_list()
-          dtype = variable.dtype
-          dset = f.create_dataset(name, shape, dtype=np.float32)
-          dset[:] = value
+      if base is not None:
+        f.attrs['base'] = base
+      options = dict(compression=compression, chunks=True) if compression else {}
+      for name, value in tqdm.tqdm(snapshot):
+        if dtype == 'bfloat16':
+          dset = f.create_dataset(name, data=to_bfloat16(value), **options)
+          dset.attrs['dtype'] = 'bfloat16'
+        else:
+          dset = f.create_dataset(name, value.shape, dtype=np.dtype(dtype or np.float32), **options)
+          dset[...] = value
     print('Writing snapshot %s' % ckpt)
     os.rename(ckpt+'.tmp', ckpt)
 
+def save_variables(ckpt, session=None, var_list=None, dtype=None, compression=None, base=None):
+    write_variables(ckpt, snapshot_variables(session=session, var_list=var_list), dtype=dtype, compression=compression, base=base)
+
+def state_path(ckpt):
+  if ckpt.endswith('.hdf5'):
+    ckpt = ckpt[:-len('.hdf5')]
+  return ckpt + '.state.hdf5'
+
+def write_state(path, snapshot, state):
+  """Writes optimizer variables (keeping their dtypes) plus a JSON blob
+  of host-side training state next to a checkpoint."""
+  maketree(os.path.dirname(path))
+  import h5py
+  with h5py.File(path + '.tmp', "w") as f:
+    f.attrs['state'] = json.dumps(state)
+    for name, value in snapshot:
+      f.create_dataset(name, data=value)
+  os.rename(path + '.tmp', path)
+
+def load_state(ckpt, session=None, var_list=None):
+  """Restores the variables written by write_state and returns the JSON
+  state, or None if the checkpoint has no training state."""
+  path = state_path(ckpt)
+  if not os.path.isfile(path):
+    return None
+  session = session or tf.get_default_session()
+  import h5py
+  with h5py.File(path, "r") as f:
+    state = json.loads(f.attrs['state'])
+    vs = [x for x in var_list or [] if x.name in f]
+    missing = [x.name for x in var_list or [] if x.name not in f]
+    if missing:
+      print('Warning: training state %s lacks %d variables, e.g. %s' % (path, len(missing), missing[0]))
+    assign_values(vs, [f[x.name][()] for x in vs], session=session)
+  return state
+
+class CheckpointRetention(object):
+  """Keeps the last `max_to_keep` checkpoints, plus one every
+  `keep_checkpoint_every_n_hours` (disabled if <= 0 or at the 10000 hour
+  default, as in tf.train.Saver), within an optional byte budget over all
+  of them. Checkpoints are rediscovered from disk on every pass, so
+  files left by earlier processes are cleaned up too. Deletion happens on
+  a background thread."""
+
+  def __init__(self, max_to_keep=5, keep_checkpoint_every_n_hours=10000.0, max_bytes=0):
+    self.max_to_keep = max_to_keep
+    self.keep_checkpoint_every_n_hours = keep_checkpoint_every_n_hours
+    self.max_bytes = max_bytes
+    self.base_cache = {}
+    self.queue = queue.Queue()
+    self.thread = None
+
+  def discover(self, directory, prefix):
+    pattern = re.compile('^' + re.escape(prefix) + r'-([0-9]+)[.]hdf5$')
+    found = []
+    with os.scandir(directory) as entries:
+      for entry in entries:
+        m = pattern.match(entry.name)
+        if m:
+          st = entry.stat()
+          found.append((int(m.group(1)), entry.path, st.st_mtime, st.st_size))
+    return sorted(found)
+
+  def select(self, checkpoints):
+    """Returns the paths to delete from [(counter, path, mtime, size), ...]."""
+    if self.max_to_keep <= 0 or len(checkpoints) <= 0:
+      return []
+    newest = checkpoints[-1]
+    keep = set(path for _, path, _, size in checkpoints[-self.max_to_keep:] if size > 0)
+    keep.add(newest[1])
+    if 0 < self.keep_checkpoint_every_n_hours < 10000:
+      # keep one checkpoint every N hours, counted from the previous one
+      # kept; the oldest checkpoint anchors the chain so later passes make
+      # the same choices
+      period = self.keep_checkpoint_every_n_hours * 3600
+      anchor = None
+      for _, path, mtime, size in checkpoints:
+        if size > 0 and (anchor is None or mtime - anchor >= period):
+          keep.add(path)
+          anchor = mtime
+    if self.max_bytes > 0:
+      kept = [(path, size) for _, path, _, size in checkpoints if path in keep]
+      total = sum(size for _, size in kept)
+      for path, size in kept:
+        if total <= self.max_bytes or path == newest[1]:
+          break
+        keep.discard(path)
+        total -= size
+    return [path for _, path, _, _ in checkpoints if path not in keep]
+
+  def bases(self, checkpoints):
+    """Returns the checkpoints that partial checkpoints among
+    [(counter, path, mtime, size), ...] restore their other variables from."""
+    found = set()
+    for _, path, mtime, size in checkpoints:
+      if size <= 0:
+        continue
+      cached = self.base_cache.get(path)
+      if cached is None or cached[0] != mtime:
+        try:
+          base = checkpoint_base(path)
+        except (OSError, IOError):
+          continue
+        cached = self.base_cache[path] = (mtime, base)
+      if cached[1] != path:
+        found.add(checkpoint_key(cached[1]))
+    return found
+
+  def enforce(self, name):
+    directory, base = os.path.split(name)
+    prefix = re.sub(r'-[0-9]+[.]hdf5$', '', base)
+    checkpoints = self.discover(directory or '.', prefix)
+    delete = set(self.select(checkpoints))
+    # never delete the base of a checkpoint that is kept
+    bases = self.bases([c for c in checkpoints if c[1] not in delete])
+    for path in sorted(delete):
+      if checkpoint_key(path) not in bases:
+        self.delete(path)
+
+  def delete(self, path):
+    if self.thread is None:
+      self.thread = threading.Thread(target=self.run, name='tflex-checkpoint-retention', daemon=True)
+      self.thread.start()
+    self.queue.put(path)
+
+  def run(self):
+    while True:
+      path = self.queue.get()
+      for fname in [path, state_path(path)]:
+        try:
+          if os.path.exists(fname):
+            print('Deleting %s' % fname)
+            os.remove(fname)
+        except OSError as e:
+          print('Failed to delete %s: %s' % (fname, e))
+      self.queue.task_done()
+
+  def wait(self):
+    self.queue.join()
+
+class CheckpointWriter(object):
+  """Runs checkpoint writes on a background thread, one at a time."""
+
+  def __init__(self):
+    self.thread = None
+    self.error = None
+
+  def wait(self):
+    if self.thread is not None:
+      self.thread.join()
+      self.thread = None
+    if self.error is not None:
+      error, self.error = self.error, None
+      raise error
+
+  def submit(self, fn):
+    # at most one save in flight; block until the previous one finishes
+    self.wait()
+    def run():
+      try:
+        fn()
+      except Exception as e:
+        print('Checkpoint write failed: %s' % e)
+        self.error = e
+    self.thread = threading.Thread(target=run, name='tflex-checkpoint-writer')
+    self.thread.start()
+
 class Saver(object):
   def __init__(
     self,
@@ -184,7 +517,16 @@ class Saver(object):
     write_version=tf.train.SaverDef.V2,
     pad_step_number=False,
     save_relative_paths=False,
-    filename=None):
+    filename=None,
+    async_save=False,
+    restore_threads=8,
+    restore_max_bytes=1<<30,
+    save_dtype=None,
+    save_compression=None,
+    save_var_list=None,
+    save_base=None,
+    state_var_list=None,
+    max_bytes=0):
     self.var_list = var_list
     self.reshape = reshape
     self.sharded = sharded
@@ -201,18 +543,26 @@ class Saver(object):
     self.save_relative_paths = save_relative_paths
     self.filename = filename
     self.checkpoints = []
+    self.retention = CheckpointRetention(max_to_keep=max_to_keep,
+      keep_checkpoint_every_n_hours=keep_checkpoint_every_n_hours, max_bytes=max_bytes)
+    self.async_save = async_save
+    self.restore_threads = restore_threads
+    self.restore_max_bytes = restore_max_bytes
+    self.save_dtype = save_dtype
+    self.save_compression = save_compression
+    # with save_base set, only save_var_list is written and the other
+    # variables are restored from save_base
+    self.save_var_list = save_var_list
+    self.save_base = save_base
+    self.state_var_list = state_var_list
+    self.writer = CheckpointWriter()
 
   def restore(self, sess, save_path):
-    if save_path.endswith('.ckpt') or os.path.isfile(save_path + '.data-00000-of-00001'):
-      load_snapshot(save_path, session=sess, var_list=self.var_list, reshape=self.reshape)
-    elif save_path.endswith('.hdf5'):
-      load_variables(save_path, session=sess, var_list=self.var_list, reshape=self.reshape)
-    elif os.path.exists(save_path + '.npy') or os.path.exists(save_path + '-0.npy'):
-      load_weights(save_path, session=sess, var_list=self.var_list, reshape=self.reshape)
-    elif os.path.exists(save_path + '.hdf5'):
-      load_variables(save_path + '.hdf5', session=sess, var_list=self.var_list, reshape=self.reshape)
-    else:
-      raise Exception("Can't load checkpoint %s" % save_path)
+    restore_checkpoint(save_path, session=sess, var_list=self.var_list, reshape=self.reshape,
+      threads=self.restore_threads, max_bytes=self.restore_max_bytes)
+
+  def restore_state(self, sess, save_path):
+    return load_state(save_path, session=sess, var_list=self.state_var_list)
 
   def save(self,
         sess,
@@ -223,24 +573,46 @@ class Saver(object):
         write_meta_graph=True,
         write_state=True,
         strip_default_attrs=False,
-        save_debug_info=False):
+        save_debug_info=False,
+        callback=None,
+        training_state=None):
+    """Saves a checkpoint. With async_save, only the copy of the variables
+    to host memory happens here; the file is written on a background
+    thread and `callback(name)` is called once it is in place.
+
+    If training_state (a JSON-serializable dict) is given, state_var_list
+    is written with it to a .state.hdf5 file beside the checkpoint."""
     if global_step is not None:
       name = '%s-%d.hdf5' % (save_path, global_step)
     else:
       name = '%s.hdf5' % save_path
-    save_variables(name, session=sess, var_list=self.var_list)
+    partial = self.save_var_list is not None and self.save_base is not None
+    snapshot = snapshot_variables(session=sess, var_list=self.save_var_list if partial else self.var_list)
+    state = None
+    if training_state is not None:
+      state = snapshot_variables(session=sess, var_list=self.state_var_list) if self.state_var_list else []
+    def commit():
+      write_variables(name, snapshot, dtype=self.save_dtype, compression=self.save_compression,
+        base=self.save_base if partial else None)
+      if state is not None:
+        write_state(state_path(name), state, training_state)
+      self.finish(name)
+      if callback is not None:
+        callback(name)
+    if self.async_save:
+      self.writer.submit(commit)
+    else:
+      commit()
+    return name
+
+  def wait(self):
+    """Blocks until any background save and cleanup has finished."""
+    self.writer.wait()
+    self.retention.wait()
+
+  def finish(self, name):
     self.checkpoints.append(name)
-    if self.max_to_keep > 0:
-      while len(self.checkpoints) > self.max_to_keep:
-        fname = self.checkpoints[0]
-        if fname != name:
-          print('Truncating %s' % fname)
-          try:
-            with open(fname, "wb") as f:
-              pass
-          except:
-            print('Failed to truncate %s' % fname)
-        self.checkpoints = self.checkpoints[1:]
+    self.retention.enforce(name)
 
 class Commands(object):
   def __init__(self, path='commands'):
@@ -432,8 +804,6 @@ def heartbeat():
     f.write(out)
     f.flush()
 
-import time
-
 @register_command
 def freeze_forever():
   cmdr = commands()
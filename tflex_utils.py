@@ -1,33 +1,138 @@
+import os
 import tqdm
 import sys
+import zipfile
+import json
+import collections
+import numpy as np
 
-def for_each_line(infile, verbose=True, ignore_errors=True, message=None):
-    n = 0
-    prev = None
-    with open(infile) as f:
-      while True:
-        try:
-          for line in f:
-            n += 1
-            prev = line
-            #print(n)
-          break
-        except UnicodeDecodeError:
-          if verbose:
-            sys.stderr.write('Error on line %d after %s\n' % (n+1, repr(prev)))
-          if not ignore_errors:
-            raise
+def for_each_line(infile, verbose=True, ignore_errors=True, message=None, start=0, errors=None, offsets=False):
+    """Yields (i, line) for each line of a utf-8 file in a single pass.
+
+    Progress is reported in bytes. Undecodable bytes are replaced unless
+    ignore_errors is False (or an explicit `errors` policy is given).
+    Reading begins at byte offset `start`, which must be a line boundary;
+    with offsets=True, (i, line, offset) is yielded, where offset is the
+    position just past the line, suitable for resuming later."""
+    if errors is None:
+      errors = 'replace' if ignore_errors else 'strict'
+    size = os.path.getsize(infile)
     if message:
-      print('%s %d lines...' % (message, n))
-    i = 0
-    with open(infile) as f:
-      while True:
-        try:
-          n -= i
-          for line in tqdm.tqdm(f, total=n) if verbose else f:
+      print('%s %s (%d bytes)...' % (message, infile, size - start))
+    with open(infile, 'rb') as f:
+      f.seek(start)
+      pos = start
+      progress = tqdm.tqdm(total=size, initial=start, unit='B', unit_scale=True) if verbose else None
+      try:
+        for i, raw in enumerate(f):
+          pos += len(raw)
+          if progress is not None:
+            progress.update(len(raw))
+          if raw.endswith(b'\r\n'):
+            raw = raw[:-2] + b'\n'
+          try:
+            line = raw.decode('utf-8', errors)
+          except UnicodeDecodeError:
+            if verbose:
+              sys.stderr.write('Error on line %d at byte %d: %s\n' % (i+1, pos - len(raw), repr(raw)))
+            raise
+          if offsets:
+            yield i, line, pos
+          else:
             yield i, line
-            i += 1
-          break
-        except UnicodeDecodeError:
-          pass
+      finally:
+        if progress is not None:
+          progress.close()
+
+class NpzWriter(object):
+  """Writes arrays one at a time into a .npz archive readable by np.load.
+
+  np.savez needs every array up front; this streams each one into the zip
+  as soon as it is added, so callers only hold the array being written."""
+
+  def __init__(self, path, compression=False):
+    self.zf = zipfile.ZipFile(path, mode='w', allowZip64=True,
+      compression=zipfile.ZIP_DEFLATED if compression else zipfile.ZIP_STORED)
+    self.count = 0
+
+  def add(self, array):
+    with self.zf.open('arr_%d.npy' % self.count, 'w', force_zip64=True) as f:
+      np.lib.format.write_array(f, np.asanyarray(array), allow_pickle=False)
+    self.count += 1
+
+  def close(self):
+    self.zf.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *excinfo):
+    self.close()
+
+class TokenShards(object):
+  """Accumulates token ids into fixed-size uint16 shards."""
+
+  def __init__(self, writer=None, shard_size=16*1024*1024, dtype=np.uint16):
+    self.writer = writer
+    self.buffer = np.zeros(shard_size, dtype=dtype)
+    self.limit = np.iinfo(dtype).max
+    self.fill = 0
+    self.total = 0
+
+  def extend(self, ids):
+    ids = np.asarray(ids)
+    assert ids.size == 0 or ids.max() <= self.limit, 'Token id too large for %s' % self.buffer.dtype
+    self.total += ids.size
+    while ids.size > 0:
+      n = min(ids.size, self.buffer.size - self.fill)
+      self.buffer[self.fill:self.fill + n] = ids[:n]
+      self.fill += n
+      ids = ids[n:]
+      if self.fill >= self.buffer.size:
+        self.flush()
+
+  def flush(self):
+    if self.fill > 0 and self.writer is not None:
+      self.writer.add(self.buffer[:self.fill])
+    self.fill = 0
+
+  def __len__(self):
+    return self.total
+
+WEIGHTS_ALIGNMENT = 64
+
+def export_weights(path, snapshot):
+  """Writes [(name, value), ...] as one flat file of aligned tensors, with
+  a JSON index of name, dtype, shape and offset in path + '.json'."""
+  dirname = os.path.dirname(path)
+  if dirname:
+    os.makedirs(dirname, exist_ok=True)
+  index = []
+  offset = 0
+  with open(path + '.tmp', 'wb') as f:
+    for name, value in snapshot:
+      value = np.asarray(value, order='C')
+      pad = -offset % WEIGHTS_ALIGNMENT
+      f.write(b'\0' * pad)
+      offset += pad
+      f.write(value.tobytes())
+      index.append({'name': name, 'dtype': value.dtype.str, 'shape': list(value.shape), 'offset': offset})
+      offset += value.nbytes
+  with open(path + '.json.tmp', 'w') as f:
+    json.dump({'tensors': index}, f, indent=1)
+  os.rename(path + '.json.tmp', path + '.json')
+  os.rename(path + '.tmp', path)
 
+def open_weights(path):
+  """Maps a file written by export_weights; returns {name: array} of
+  read-only views, so processes share the page cache instead of copies."""
+  with open(path + '.json') as f:
+    index = json.load(f)['tensors']
+  data = np.memmap(path, dtype=np.uint8, mode='r')
+  weights = collections.OrderedDict()
+  for tensor in index:
+    dtype = np.dtype(tensor['dtype'])
+    count = int(np.prod(tensor['shape']))
+    view = data[tensor['offset']:tensor['offset'] + count * dtype.itemsize]
+    weights[tensor['name']] = view.view(dtype).reshape(tensor['shape'])
+  return weights
@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 import argparse
-import numpy as np
 
 from tokenizers import Tokenizer, models, pre_tokenizers, decoders
 
@@ -11,6 +10,7 @@ parser.add_argument('--model_name', metavar='MODEL', type=str, default='117M', h
 parser.add_argument('--combine', metavar='CHARS', type=int, default=50000, help='Concatenate files with <|endoftext|> separator into chunks of this minimum size')
 parser.add_argument('-s', '--step', type=int, default=128*1024, help='Number of lines to encode at a time')
 parser.add_argument('-b', '--batch', action='store_true', default=False, help='Use tokenizer.encode_batch')
+parser.add_argument('--shard_size', type=int, default=16*1024*1024, help='Number of tokens per uint16 array in the output .npz')
 parser.add_argument('-c', '--compression', action='store_true', default=False, help='Save using compression (via .savez_compressed)')
 parser.add_argument('in_text', metavar='PATH', type=str, help='Input file')
 parser.add_argument('out_npz', metavar='OUT.npz', type=str, default='', nargs='?', help='Output file path')
@@ -54,30 +54,28 @@ if padding:
     pad_token
   )
 
-# http://stackoverflow.com/questions/1624883/alternative-way-to-split-a-list-into-groups-of-n
 import itertools
-def group(n, iterable, fillvalue=None):
-    "group(3, 'ABCDEFG', 'x') --> ABC DEF Gxx"
-    args = [iter(iterable)] * n
-    return itertools.zip_longest(*args, fillvalue=fillvalue)
 
 import tflex_utils
-import tqdm
 import time
 start = time.time()
 optional_pair_sequence = None
-tokens = []
+writer = None
+if args.out_npz and len(args.out_npz) > 0:
+  print('Saving to %s...' % args.out_npz)
+  writer = tflex_utils.NpzWriter(args.out_npz, compression=args.compression)
+tokens = tflex_utils.TokenShards(writer, shard_size=args.shard_size)
 if args.batch:
   with open(args.in_text) as f:
     print('Reading...')
-    lines = f.readlines()
-    print(repr(lines[0]))
-  batches = [x for x in group(args.step, lines, fillvalue='\n')]
-  for batch in tqdm.tqdm(batches):
-    for encoding in tokenizer.encode_batch([x for x in batch]):
-      tokens.extend(encoding.ids)
-      elapsed = time.time() - start
-      print('%d tokens in %.4fs (%.4f tokens/sec)' % (len(tokens), elapsed, len(tokens)/elapsed))
+    while True:
+      batch = list(itertools.islice(f, args.step))
+      if len(batch) <= 0:
+        break
+      for encoding in tokenizer.encode_batch(batch):
+        tokens.extend(encoding.ids)
+        elapsed = time.time() - start
+        print('%d tokens in %.4fs (%.4f tokens/sec)' % (len(tokens), elapsed, len(tokens)/elapsed))
 else:
   for i, line in tflex_utils.for_each_line(args.in_text):
     encoding = tokenizer.encode(line, optional_pair_sequence)
@@ -85,12 +83,8 @@ else:
     if i % args.step == 0:
       elapsed = time.time() - start
       print('%d tokens in %.4fs (%.4f tokens/sec)' % (len(tokens), elapsed, len(tokens)/elapsed))
+tokens.flush()
+if writer is not None:
+  writer.close()
 elapsed = time.time() - start
 print('%d tokens in %.4fs (%.4f tokens/sec)' % (len(tokens), elapsed, len(tokens)/elapsed))
-if args.out_npz and len(args.out_npz) > 0:
-  print('Saving to %s...' % args.out_npz)
-  if args.compression:
-    np.savez_compressed(args.out_npz, tokens)
-  else:
-    np.savez(args.out_npz, tokens)
-
@@ -15,7 +15,7 @@ from tensorflow.core.protobuf import rewriter_config_pb2
 from tensorflow.python import pywrap_tensorflow
 
 import model, sample, encoder
-from load_dataset import load_dataset, Sampler, TextSampler
+from load_dataset import load_dataset, Sampler, TextSampler, MmapTextSampler, sampler_state, set_sampler_state
 from accumulate import AccumulatingOptimizer
 import memory_saving_gradients
 from glob import glob
@@ -23,7 +23,6 @@ import re
 import tflex
 import tflex_sgdr
 
-import pytz
 from datetime import datetime, timezone
 
 CHECKPOINT_DIR = 'checkpoint'
@@ -37,6 +36,7 @@ parser = argparse.ArgumentParser(
 parser.add_argument('--dataset', metavar='PATH', type=str, required=True, help='Input file, directory, or glob pattern (utf-8 text, or preencoded .npz files).')
 parser.add_argument('--model_name', metavar='MODEL', type=str, default='117M', help='Pretrained model name')
 parser.add_argument('--combine', metavar='CHARS', type=int, default=50000, help='Concatenate input files with <|endoftext|> separator into chunks of this minimum size')
+parser.add_argument('--dataset_cache', metavar='PATH', type=str, default='', help='Keep encoded text chunks in this directory and reuse them on restart. Disabled if empty.')
 
 parser.add_argument('--batch_size', metavar='SIZE', type=int, default=1, help='Batch size')
 parser.add_argument('--learning_rate', metavar='LR', type=float, default=0.00002, help='Learning rate for Adam')
@@ -61,7 +61,14 @@ parser.add_argument('--sample_length', metavar='TOKENS', type=int, default=-1, h
 parser.add_argument('--sample_num', metavar='N', type=int, default=1, help='Generate this many samples')
 parser.add_argument('--save_every', metavar='N', type=int, default=-1, help='Write a checkpoint every N steps')
 parser.add_argument('--save_time', metavar='N', type=float, default=15.0, help='Write a checkpoint every N minutes')
+parser.add_argument('--save_async', default=False, action='store_true', help='Copy weights to host memory and write the checkpoint on a background thread while training continues')
+parser.add_argument('--save_dtype', type=str, default='float32', choices=['float32', 'float16', 'bfloat16'], help='Storage type for checkpoint weights. <float32|float16|bfloat16>. Restored as float32.')
+parser.add_argument('--save_compression', type=str, default=None, choices=['gzip', 'lzf'], help='HDF5 compression for checkpoints. <gzip|lzf>. Disabled if unset.')
+parser.add_argument('--save_trainable_only', default=False, action='store_true', help='Only write the trained variables; the rest are restored from the checkpoint this run started from. Useful with --only_train_transformer_layers.')
+parser.add_argument('--save_training_state', default=False, action='store_true', help='Also save optimizer slots, step counters and the data sampler RNG with each checkpoint, and resume from them')
 parser.add_argument('--max_to_keep', metavar='N', type=int, default=5, help='Only keep the last N checkpoints')
+parser.add_argument('--keep_checkpoint_every_n_hours', metavar='HOURS', type=float, default=0.0, help='Additionally keep one checkpoint every HOURS hours. Disabled if set <= 0')
+parser.add_argument('--max_checkpoint_gb', metavar='GB', type=float, default=0.0, help='Delete the oldest checkpoints while the run uses more than GB gigabytes. Disabled if set <= 0')
 
 parser.add_argument('--val_dataset', metavar='PATH', type=str, default=None, help='Dataset for validation loss, defaults to --dataset.')
 parser.add_argument('--val_batch_size', metavar='SIZE', type=int, default=1, help='Batch size for validation.')
@@ -98,6 +105,7 @@ parser.add_argument('--n_ctx', type=int, default=-1, help='For a fresh model, ho
 parser.add_argument('--n_embd', type=int, default=-1, help='For a fresh model, how large should n_embd be?')
 parser.add_argument('--n_head', type=int, default=-1, help='For a fresh model, how large should n_head be?')
 parser.add_argument('--n_layer', type=int, default=-1, help='For a fresh model, how large should n_layer be?')
+parser.add_argument('--pad_vocab', type=int, default=-1, help='Round the vocabulary up to a multiple of N (e.g. 64 or 128) for aligned embedding and logits matmuls. Use --truncate_weights to convert an existing checkpoint.')
 
 parser.add_argument('--sample_ctx', type=int, default=-1, help='Compute loss over N samples. Equal to n_ctx if set < 0.')
 
@@ -113,16 +121,22 @@ parser.add_argument('--debug_before_training', default=False, action='store_true
 
 parser.add_argument('--dropout', type=float, default=0.0, help="Dropout value. Disabled if set <= 0.0. For training on large datasets, 0.1 tends to be a good value.")
 
+parser.add_argument('--text_sampler', type=str, default='seek', help='How to sample raw text datasets. <seek|mmap|line>. seek (default) uses the file-seeking sampler; mmap maps the file and snaps to character boundaries; line also snaps to line starts.')
+
 parser.add_argument('--seed', type=int, default=-1, help='Deterministic seed for dataset sampler. Disabled if set < 0')
 
 parser.add_argument('--save_graph', default=False, action='store_true', help="Save TensorFlow graph to summary log (to see ops in tensorboard)")
 
-PST = pytz.timezone('US/Pacific')
+PST = None
 
 def timestamp(now=None, tz=None):
+    global PST
     if now is None:
         now = datetime.now(timezone.utc)
     if tz is None:
+        if PST is None:
+            import pytz
+            PST = pytz.timezone('US/Pacific')
         tz = PST
     return "{}".format(now.astimezone(tz).isoformat())
 
@@ -173,6 +187,8 @@ def main():
         hparams.n_head=args.n_head
     if args.n_layer >= 0:
         hparams.n_layer=args.n_layer
+    if args.pad_vocab >= 0:
+        hparams.pad_vocab=args.pad_vocab
 
     if args.sample_length < 0:
         args.sample_length = hparams.n_ctx - 1
@@ -312,11 +328,6 @@ def main():
         if args.save_graph:
             summary_log.add_graph(tf.get_default_graph())
 
-        saver = tflex.Saver(
-            var_list=all_vars,
-            max_to_keep=args.max_to_keep,
-            keep_checkpoint_every_n_hours=2,
-            reshape=args.truncate_weights)
         sess.run(tf.global_variables_initializer())
 
         if args.restore_from == 'latest':
@@ -331,6 +342,19 @@ def main():
                 os.path.join('models', args.model_name))
         else:
             ckpt = tflex.latest_checkpoint(args.restore_from)
+
+        saver = tflex.Saver(
+            var_list=all_vars,
+            max_to_keep=args.max_to_keep,
+            keep_checkpoint_every_n_hours=args.keep_checkpoint_every_n_hours,
+            max_bytes=int(args.max_checkpoint_gb * 1024**3),
+            reshape=args.truncate_weights,
+            async_save=args.save_async,
+            save_dtype=args.save_dtype,
+            save_compression=args.save_compression,
+            save_var_list=train_vars if args.save_trainable_only else None,
+            save_base=None if args.fresh_model else tflex.checkpoint_base(ckpt),
+            state_var_list=[v for v in tf.global_variables() if v.name not in set(x.name for x in all_vars)])
         print('Loading snapshot %s...' % ckpt)
         t0 = time.time()
         if not args.fresh_model:
@@ -339,12 +363,15 @@ def main():
         print('Loaded in %f seconds' % (t1 - t0))
 
         def make_sampler(dataset, enc, seed, combine):
-          if os.path.isdir(dataset) or dataset.endswith('.npz'):
-            chunks = load_dataset(enc, dataset, combine)
+          if os.path.isdir(dataset) or dataset.endswith('.npz') or dataset.endswith('.json'):
+            chunks = load_dataset(enc, dataset, combine, cache_dir=args.dataset_cache)
             data_sampler = Sampler(chunks, seed=seed)
             print('dataset has', data_sampler.total_size, 'tokens', len(chunks), 'chunks')
-          else:
+          elif args.text_sampler == 'seek':
             data_sampler = TextSampler(dataset, enc, seed=seed)
+          else:
+            snap = 'line' if args.text_sampler == 'line' else 'utf8'
+            data_sampler = MmapTextSampler(dataset, enc, seed=seed, snap=snap)
           return data_sampler
 
         print('Loading dataset...')
@@ -367,6 +394,15 @@ def main():
             with open(counter_path, 'r') as fp:
                 counter = int(fp.read()) + 1
 
+        if args.save_training_state and not args.fresh_model:
+            state = saver.restore_state(sess, ckpt)
+            if state is not None:
+                print('Resuming training state from step %d' % state['counter'])
+                counter = state['counter'] + 1
+                current_step = state['current_step']
+                args.learning_rate = state['learning_rate']
+                set_sampler_state(data_sampler, state['sampler'])
+
         @tflex.register_command
         def save():
             maketree(os.path.join(CHECKPOINT_DIR, args.run_name))
@@ -375,14 +411,28 @@ def main():
                 os.path.join(CHECKPOINT_DIR, args.run_name,
                              'model-{}').format(counter))
             t0 = time.time()
+            saved_counter = counter
+            def saved(name):
+                t2 = time.time()
+                print('Wrote %s in %f seconds' % (name, t2 - t0))
+                with open(counter_path, 'w') as fp:
+                    fp.write(str(saved_counter) + '\n')
+            training_state = None
+            if args.save_training_state:
+                training_state = {
+                    'counter': counter,
+                    'current_step': current_step,
+                    'learning_rate': args.learning_rate,
+                    'sampler': sampler_state(data_sampler),
+                }
             saver.save(
                 sess,
                 os.path.join(CHECKPOINT_DIR, args.run_name, 'model'),
-                global_step=counter)
+                global_step=counter,
+                callback=saved,
+                training_state=training_state)
             t1 = time.time()
             print('Saved in %f seconds' % (t1 - t0))
-            with open(counter_path, 'w') as fp:
-                fp.write(str(counter) + '\n')
 
         @tflex.register_command
         def generate_samples():
@@ -394,8 +444,8 @@ def main():
                 out = sess.run(
                     tf_sample,
                     feed_dict={context: args.batch_size * [context_tokens]})
-                for i in range(min(args.sample_num - index, args.batch_size)):
-                    text = enc.decode(out[i])
+                texts = enc.decode_batch(out[:args.sample_num - index])
+                for text in texts:
                     text = '======== SAMPLE {} ========\n{}\n'.format(
                         index + 1, text)
                     print(text)
@@ -577,5 +627,8 @@ def main():
                 else:
                     break
 
+        # let a background save finish before the session goes away
+        saver.wait()
+
 if __name__ == '__main__':
     main()